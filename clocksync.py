@@ -0,0 +1,72 @@
+"""Host commands run on schedule by the robot's clock.
+
+The host learns how the robot's time.monotonic clock relates to its own
+NTP style, with 'sync' round trips over the command link (see
+host/timing.py): reply() answers each with when the request arrived and
+when the answer left. With that offset the host marks a command with the
+moment it should run on the robot's clock, 'forward @1234.5678', a fixed
+lead after the input was sampled. The robot holds such commands in a
+Schedule until then, so network jitter shorter than the lead no longer
+shows in the timing of the motion.
+
+Commands without a time, or whose time has passed, run at once. Times more
+than MAX_LEAD ahead are brought forward to it, so a bad clock estimate
+can't hold a command back for long. A walking robot changes mode only
+between gait cycles, so a command that falls due mid-cycle runs at the end
+of it; frames in 'offload' mode keep their times.
+"""
+
+import heapq
+import itertools
+import time
+import metrics
+
+MAX_LEAD = 1.0
+
+def unschedule(command):
+    """Split 'verb args @time' into ('verb args', time); time is None if unscheduled."""
+    head, sep, at = command.rpartition(' @')
+    if sep:
+        try:
+            return head, float(at)
+        except ValueError:
+            pass
+    return command, None
+
+def reply(received):
+    """Answer to 'sync' received at `received`: that and the time now, on this clock."""
+    return '{:.6f} {:.6f}'.format(received, time.monotonic())
+
+class Schedule:
+    """Items held until their execution times, then handed out in time order."""
+
+    def __init__(self, max_lead=MAX_LEAD):
+        self.max_lead = max_lead
+        self.heap = []
+        self.order = itertools.count()  # keeps items due at the same time in arrival order
+
+    def push(self, item, at=None):
+        now = time.monotonic()
+        if at is None:
+            at = now
+        elif at > now + self.max_lead:
+            metrics.count('schedule.clamped')
+            at = now + self.max_lead
+        heapq.heappush(self.heap, (at, next(self.order), item))
+
+    def wait(self):
+        """Seconds until the next item is due (0 if one is), or None if nothing is waiting."""
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - time.monotonic())
+
+    def due(self):
+        """Remove and return the items whose time has come, earliest first."""
+        now = time.monotonic()
+        items = []
+        while self.heap and self.heap[0][0] <= now:
+            at, _, item = heapq.heappop(self.heap)
+            if metrics.enabled:
+                metrics.histogram('schedule.late').record(now - at)
+            items.append(item)
+        return items
@@ -0,0 +1,50 @@
+"""Central pattern generator: banks of sine oscillators stepped as NumPy vectors.
+
+Each channel's output is offset + amplitude*sin(phase), and its phase
+advances by 2*pi*frequency per second. step() advances every channel at
+once, so a full frame costs a handful of array operations whatever the
+channel count. Parameters change smoothly: set() glides frequency,
+amplitude and offset to new values over a ramp time. Because the phase is
+integrated, not computed from the time, a frequency change never makes
+the output jump.
+"""
+
+import numpy as np
+
+PARAMETERS = ('frequency', 'amplitude', 'offset')
+
+class Oscillators:
+    """One oscillator per channel; parameters are scalars or per-channel sequences."""
+
+    def __init__(self, channels, frequency=1.0, amplitude=0.0, offset=0.0, phase=0.0):
+        self.channels = channels
+        self.phase = np.zeros(channels) + phase
+        self.values = {}
+        self.targets = {}
+        self.rates = {}
+        for name, value in zip(PARAMETERS, (frequency, amplitude, offset)):
+            self.values[name] = np.zeros(channels) + value
+            self.targets[name] = self.values[name].copy()
+            self.rates[name] = np.zeros(channels)
+
+    def set(self, ramp=0.0, **parameters):
+        """Move the named parameters to new values, linearly over `ramp` seconds."""
+        for name, value in parameters.items():
+            if name not in self.values:
+                raise ValueError('Unknown oscillator parameter {}'.format(name))
+            self.targets[name] = np.zeros(self.channels) + value
+            if ramp > 0:
+                self.rates[name] = np.abs(self.targets[name] - self.values[name])/ramp
+            else:
+                self.values[name] = self.targets[name].copy()
+
+    def step(self, dt):
+        """Advance dt seconds and return every channel's output."""
+        for name in PARAMETERS:
+            value, target = self.values[name], self.targets[name]
+            if not np.array_equal(value, target):
+                change = np.clip(target - value, -self.rates[name]*dt, self.rates[name]*dt)
+                value += change
+        self.phase += 2*np.pi*self.values['frequency']*dt
+        self.phase %= 2*np.pi
+        return self.values['offset'] + self.values['amplitude']*np.sin(self.phase)
@@ -27,13 +27,42 @@ Compact is a 30 degree angle beetween coxae, 15 degrees between tibia and patell
 and 75 degree tibia above horizontal.
 """
 
+import asyncio
+import clocksync
+import cpg
+import functools
+import ikcache
 import maestro
+import metrics
+import numpy as np
+import os
+import primitives
+import recorder
+import servobus
+import struct
+import sys
 import time
-from math import sqrt, sin, cos, pi, atan2
+import trajectory
+from math import sqrt, sin, cos, pi, acos, atan2, ceil, isfinite
 import zmq
 import queue
 
-control = maestro.Controller(ttyStr='/dev/ttyO1')
+# EPOCHE_TTY=sim drives a maestro.SimulatedSerial instead of the real controller;
+# a comma-separated list shards the channels over several Maestros (see servobus.py)
+tty = os.environ.get('EPOCHE_TTY', '/dev/ttyO1')
+if ',' in tty:
+    control = servobus.ServoBus(servobus.parse(tty))
+else:
+    control = maestro.Controller(ttyStr=tty, usb=maestro.SimulatedSerial() if tty == 'sim' else None)
+
+# host commands may carry a trace ID; follow them to the first servo byte
+tracer = metrics.Tracer('receive', 'gait', 'serial')
+control.writeHooks.append(lambda data: tracer.stamp('serial'))
+metrics.instrument(control.usb, 'write', 'usb.write')
+
+# EPOCHE_PIPELINE=1 sends pose() frames from a transmit thread, so the next
+# frame's angles are worked out while the last one is still on the wire
+pipeline = maestro.FramePipeline(control) if os.environ.get('EPOCHE_PIPELINE') else None
 
 servo_info = [
     # coxae
@@ -63,272 +92,210 @@ coxa = [0,1,2,3,4,5]
 tibia = [6,7,8,9,10,11]
 patella = [12,13,14,15,16,17]
 
-def move(servo, angle):
+def target(servo, angle):
+    """Maestro target for a servo angle in degrees."""
     info = servo_info[servo]
-    control.setTarget(info['pin'], int(info['home']+angle*3000/90*info['dir']))
+    return int(info['home']+angle*3000/90*info['dir'])
+
+# servo_info as arrays, for converting many angles at once
+PINS = [info['pin'] for info in servo_info]
+HOMES = np.array([info['home'] for info in servo_info])
+STEPS = np.array([3000/90*info['dir'] for info in servo_info])
+
+@metrics.timed('move')
+def move(servo, angle):
+    pose({servo: angle})
+
+@metrics.timed('pose')
+def pose(angles, duration=None):
+    """Send {servo: angle} as one bulk write, timed so all servos arrive together.
+
+    Each channel gets the Maestro speed that covers its own distance in
+    `duration` seconds, sent in bulk ahead of the targets, so the controller
+    interpolates and no joint finishes early. Without a duration servos move
+    at full speed.
+    """
+    targets = {}
+    speeds = {}
+    for servo, angle in angles.items():
+        pin = servo_info[servo]['pin']
+        targets[pin] = target(servo, angle)
+        distance = abs(targets[pin] - control.Targets[pin])
+        if not duration or not control.Targets[pin]:
+            speeds[pin] = 0
+        elif distance:
+            # speed is in quarter-microseconds per 10ms
+            speeds[pin] = max(1, ceil(distance/(duration*100)))
+    # primitives.capture swaps in its own controller, which must not be pipelined
+    if pipeline is not None and pipeline.control is control:
+        pipeline.send(speeds, targets)
+    else:
+        control.setSpeeds(speeds)
+        control.setTargets(targets)
+
+# a settling gait phase gives up after this many times its nominal duration
+SETTLE_TIMEOUT = 3
+
+def pause(seconds, servos=None):
+    """Let a motion play out: until `servos` reach their targets, or for `seconds` if none are given.
 
+    Compiling primitives swaps this out to find frame boundaries.
+    """
+    if servos:
+        # queries wait for pipelined frames still going out (see Controller.write)
+        control.wait_until_settled([servo_info[servo]['pin'] for servo in servos], SETTLE_TIMEOUT*seconds)
+    else:
+        control.sleep(seconds)
+
+# Leg geometry (see GEOMETRY above) in body coordinates: x to the right, y
+# forward, z up, in mm. Legs are numbered like coxa/tibia/patella: front,
+# middle and back pairs with the left leg first. Each leg's coxa mount and the
+# direction its coxa points at 0 degrees, anticlockwise from +x.
+LEGS = [
+    ((-22.5, 37.85), 130),
+    ((22.5, 37.85), 50),
+    ((-37.7, 0), 180),
+    ((37.7, 0), 0),
+    ((-22.5, -37.85), 230),
+    ((22.5, -37.85), -50),
+]
+COXA_LENGTH = 35.0
+TIBIA_LENGTH = 50.0
+PATELLA_LENGTH = 94.8 + 6.7
+# standing pose the body is measured from: feet stay where these angles put them
+STAND_TIBIA = 29.3
+STAND_PATELLA = -(180-60.7)
+
+def _foot(angle_tibia, angle_patella):
+    """(reach from the coxa mount, height) of a foot for tibia and patella angles."""
+    a = angle_tibia*pi/180
+    b = (angle_tibia + angle_patella)*pi/180
+    return (COXA_LENGTH + TIBIA_LENGTH*cos(a) + PATELLA_LENGTH*cos(b),
+            TIBIA_LENGTH*sin(a) + PATELLA_LENGTH*sin(b))
+
+STAND_REACH, STAND_HEIGHT = _foot(STAND_TIBIA, STAND_PATELLA)
+FEET = np.array([(x + STAND_REACH*cos(heading*pi/180), y + STAND_REACH*sin(heading*pi/180), STAND_HEIGHT)
+                 for (x, y), heading in LEGS])
+
+# IK results are cached for poses rounded to this many mm/degrees (see ikcache.py)
+IK_RESOLUTION = float(os.environ.get('EPOCHE_IK_RESOLUTION', 0.1))
+IK_CACHE_BYTES = 4 << 20
+
+MOUNTS = np.array([mount for mount, heading in LEGS])
+HEADINGS = np.array([heading for mount, heading in LEGS])
+# coxa angles are mirrored on the right, so positive swings every foot forward
+# (the stepped gaits lift a tripod and swing it to +forward to walk forward)
+SIDES = np.array([-1 if leg % 2 == 0 else 1 for leg in range(6)])
+
+def solve_feet(x, y, z):
+    """{servo: angles} putting the feet at x, y, z: arrays (..., 6) in body coordinates.
+
+    Any leading dimensions are solved in one pass, e.g. every tick of a gait.
+    Unreachable feet get the nearest leg extension.
+    """
+    x = x - MOUNTS[:, 0]
+    y = y - MOUNTS[:, 1]
+    swing = (np.degrees(np.arctan2(y, x)) - HEADINGS + 180) % 360 - 180
+    reach = np.hypot(x, y) - COXA_LENGTH
+    span = np.maximum(np.hypot(reach, z), 1e-6)
+    # two-link IK in the leg's vertical plane
+    lift = np.arctan2(z, reach) + np.arccos(np.clip(
+        (TIBIA_LENGTH**2 + span**2 - PATELLA_LENGTH**2)/(2*TIBIA_LENGTH*span), -1, 1))
+    knee = np.arccos(np.clip(
+        (TIBIA_LENGTH**2 + PATELLA_LENGTH**2 - span**2)/(2*TIBIA_LENGTH*PATELLA_LENGTH), -1, 1))
+    angles = {}
+    for leg in range(6):
+        angles[coxa[leg]] = SIDES[leg]*swing[..., leg]
+        angles[tibia[leg]] = np.degrees(lift[..., leg])
+        angles[patella[leg]] = np.degrees(knee[..., leg]) - 180
+    return angles
+
+@ikcache.cached(IK_RESOLUTION, IK_CACHE_BYTES, 'ik')
+@metrics.timed('ik')
 def calculate_servo_angles(PosX=0, PosY=0, PosZ=0, RotX=0, RotY=0, RotZ=0):
+    """{servo: angle} holding the feet where they stand with the body moved.
 
-    BodySideLength = 45
-    CoxaLength = 35
-    FemurLength = 50
-    TibiaLength = 95
-    
-    BodyCenterOffset1 = BodySideLength/2
-    BodyCenterOffset2 = sqrt(BodySideLength**2 - BodyCenterOffset1**2)
-    
-    # Body Center Offset X
-    
-    BodyCenterOffsetX_1 = BodyCenterOffset1
-    BodyCenterOffsetX_2 = BodySideLength
-    BodyCenterOffsetX_3 = BodyCenterOffset1
-    BodyCenterOffsetX_4 = -BodyCenterOffset1
-    BodyCenterOffsetX_5 = -BodySideLength
-    BodyCenterOffsetX_6 = -BodyCenterOffset1
-    
-    # Body Center Offset Y
-    
-    BodyCenterOffsetY_1 = BodyCenterOffset2
-    BodyCenterOffsetY_2 = 0
-    BodyCenterOffsetY_3 = -BodyCenterOffset2
-    BodyCenterOffsetY_4 = -BodyCenterOffset2
-    BodyCenterOffsetY_5 = 0
-    BodyCenterOffsetY_6 = BodyCenterOffset2
-    
-    # Initial Feet Positions
-    
-    FeetPosX_1 = cos(60/180*pi)*(CoxaLength + FemurLength)
-    FeetPosZ_1 = TibiaLength
-    FeetPosY_1 = sin(60/180*pi)*(CoxaLength + FemurLength)
-    
-    FeetPosX_2 = CoxaLength + FemurLength
-    FeetPosZ_2 = TibiaLength
-    FeetPosY_2 = 0
-    
-    FeetPosX_3 = cos(60/180*pi)*(CoxaLength + FemurLength)
-    FeetPosZ_3 = TibiaLength
-    FeetPosY_3 = sin(-60/180*pi)*(CoxaLength + FemurLength)
-    
-    FeetPosX_4 = -cos(60/180*pi)*(CoxaLength + FemurLength)
-    FeetPosZ_4 = TibiaLength
-    FeetPosY_4 = sin(-60/180*pi)*(CoxaLength + FemurLength)
-    
-    FeetPosX_5 = -(CoxaLength + FemurLength)
-    FeetPosZ_5 = TibiaLength
-    FeetPosY_5 = 0
-    
-    FeetPosX_6 = -cos(60/180*pi)*(CoxaLength + FemurLength)
-    FeetPosZ_6 = TibiaLength
-    FeetPosY_6 = sin(60/180*pi)*(CoxaLength + FemurLength)
-    
-    # Body IK
-    
-    TotalY_1 = FeetPosY_1 + BodyCenterOffsetY_1 + PosY
-    TotalX_1 = FeetPosX_1 + BodyCenterOffsetX_1 + PosX
-    DistBodyCenterFeet_1 = sqrt(TotalY_1**2 + TotalX_1**2)
-    AngleBodyCenterX_1 = pi/2 - atan2(TotalY_1, TotalX_1)
-    RollZ_1 = tan(RotZ * pi/180) * TotalX_1
-    PitchZ_1 = tan(RotX * pi/180) * TotalY_1
-    BodyIKX_1 = cos(AngleBodyCenterX_1 + (RotY * pi/180)) * DistBodyCenterFeet_1 - TotalX_1
-    BodyIKY_1 = (sin(AngleBodyCenterX_1 + (RotY  * pi/180)) * DistBodyCenterFeet_1) - TotalY_1
-    BodyIKZ_1 = RollZ_1 + PitchZ_1
-    
-    TotalY_2 = FeetPosY_2 + BodyCenterOffsetY_2 + PosY
-    TotalX_2 = FeetPosX_2 + PosX + BodyCenterOffsetX_2
-    DistBodyCenterFeet_2 = sqrt(TotalY_2**2 + TotalX_2**2)
-    AngleBodyCenterX_2 = pi/2 - atan2(TotalY_2, TotalX_2)
-    RollZ_2 = tan(RotZ * pi/180) * TotalX_2
-    PitchZ_2 = tan(RotX * pi/180) * TotalY_2
-    BodyIKX_2 = cos(AngleBodyCenterX_2 + (RotY * pi/180)) * DistBodyCenterFeet_2 - TotalX_2
-    BodyIKY_2 = (sin(AngleBodyCenterX_2 + (RotY  * pi/180)) * DistBodyCenterFeet_2) - TotalY_2
-    BodyIKZ_2 = RollZ_2 + PitchZ_2
-    
-    TotalY_3 = FeetPosY_3 + BodyCenterOffsetY_3 + PosY
-    TotalX_3 = FeetPosX_3 + BodyCenterOffsetX_3 + PosX
-    DistBodyCenterFeet_3 = sqrt(TotalY_3**2 + TotalX_3**2)
-    AngleBodyCenterX_3 = pi/2 - atan2(TotalY_3, TotalX_3)
-    RollZ_3 = tan(RotZ * pi/180) * TotalX_3
-    PitchZ_3 = tan(RotX * pi/180) * TotalY_3
-    BodyIKX_3 = cos(AngleBodyCenterX_3 + (RotY * pi/180)) * DistBodyCenterFeet_3 - TotalX_3
-    BodyIKY_3 = (sin(AngleBodyCenterX_3 + (RotY  * pi/180)) * DistBodyCenterFeet_3) - TotalY_3
-    BodyIKZ_3 = RollZ_3 + PitchZ_3
-    
-    TotalY_4 = FeetPosY_4 + BodyCenterOffsetY_4 + PosY
-    TotalX_4 = FeetPosX_4 + BodyCenterOffsetX_4 + PosX
-    DistBodyCenterFeet_4 = sqrt(TotalY_4**2 + TotalX_4**2)
-    AngleBodyCenterX_4 = pi/2 - atan2(TotalY_4, TotalX_4)
-    RollZ_4 = tan(RotZ * pi/180) * TotalX_4
-    PitchZ_4 = tan(RotX * pi/180) * TotalY_4
-    BodyIKX_4 = cos(AngleBodyCenterX_4 + (RotY * pi/180)) * DistBodyCenterFeet_4 - TotalX_4
-    BodyIKY_4 = (sin(AngleBodyCenterX_4 + (RotY  * pi/180)) * DistBodyCenterFeet_4) - TotalY_4
-    BodyIKZ_4 = RollZ_4 + PitchZ_4
-    
-    TotalY_5 = FeetPosY_5 + BodyCenterOffsetY_5 + PosY
-    TotalX_5 = FeetPosX_5 + BodyCenterOffsetX_5 + PosX
-    DistBodyCenterFeet_5 = sqrt(TotalY_5**2 + TotalX_5**2)
-    AngleBodyCenterX_5 = pi/2 - atan2(TotalY_5, TotalX_5)
-    RollZ_5 = tan(RotZ * pi/180) * TotalX_5
-    PitchZ_5 = tan(RotX * pi/180) * TotalY_5
-    BodyIKX_5 = cos(AngleBodyCenterX_5 + (RotY * pi/180)) * DistBodyCenterFeet_5 - TotalX_5
-    BodyIKY_5 = (sin(AngleBodyCenterX_5 + (RotY  * pi/180)) * DistBodyCenterFeet_5) - TotalY_5
-    BodyIKZ_5 = RollZ_5 + PitchZ_5
-    
-    TotalY_6 = FeetPosY_6 + BodyCenterOffsetZY_6 + PosY
-    TotalX_6 = FeetPosX_6 + BodyCenterOffsetX_6 + PosX
-    DistBodyCenterFeet_6 = sqrt(TotalY_6**2 + TotalX_6**2)
-    AngleBodyCenterX_6 = pi/2 - atan2(TotalY_6, TotalX_6)
-    RollZ_6 = tan(RotZ * pi/180) * TotalX_6
-    PitchZ_6 = tan(RotX * pi/180) * TotalY_6
-    BodyIKX_6 = cos(AngleBodyCenterX_6 + (RotY * pi/180)) * DistBodyCenterFeet_6 - TotalX_6
-    BodyIKY_6 = (sin(AngleBodyCenterX_6 + (RotY  * pi/180)) * DistBodyCenterFeet_6) - TotalY_6
-    BodyIKZ_6 = RollZ_6 + PitchZ_6
-    
-    # More IK
-    
-    NewPosX_1 = FeetPosX_1 + PosX +  BodyIKX_1
-    NewPosZ_1 = FeetPosZ_1 + PosZ + BodyIKZ_1
-    NewPosY_1 = FeetPosY_1 + PosY + BodyIKY_1
-    CoxaFeetDist_1 = sqrt(NewPosX_1**2   + NewPosY_1**2)
-    IKSW_1 = sqrt((CoxaFeetDist_1 - CoxaLength ) **2 + NewPosZ_1**2)
-    IKA1_1 = atan((CoxaFeetDist_1 - CoxaLength)/NewPosZ_1)
-    IKA2_1 = acos((TibiaLength**2 - FemurLength**2 - IKSW_1**2)/(-2 * IKSW_1 *  FemurLength))
-    TAngle_1 = acos((IKSW_1**2 - TibiaLength**2 - FemurLength**2)/(-2 * FemurLength * TibiaLength))
-    IKTibiaAngle_1 = 90 - TAngle_1 * 180/pi
-    IKFemurAngle_1 = 90 - (IKA1_1 + IKA2_1) * 180/pi
-    IKCoxaAngle_1 = 90 - atan2(NewPosY_1, NewPosX_1) * 180/pi
-    
-    NewPosX_2 = FeetPosX_2 + PosX +  BodyIKX_2
-    NewPosZ_2 = FeetPosZ_2 + PosZ + BodyIKZ_2
-    NewPosY_2 = FeetPosY_2 + PosY + BodyIKY_2
-    CoxaFeetDist_2 = sqrt(NewPosX_2**2   + NewPosY_2**2)
-    IKSW_2 = sqrt((CoxaFeetDist_2 - CoxaLength ) **2 + NewPosZ_2**2)
-    IKA1_2 = atan((CoxaFeetDist_2 - CoxaLength)/NewPosZ_2)
-    IKA2_2 = acos((TibiaLength**2 - FemurLength**2 - IKSW_2**2)/(-2 * IKSW_2 *  FemurLength))
-    TAngle_2 = acos((IKSW_2**2 - TibiaLength**2 - FemurLength**2)/(-2 * FemurLength * TibiaLength))
-    IKTibiaAngle_2 = 90 - TAngle_2 * 180/pi
-    IKFemurAngle_2 = 90 - (IKA1_2 + IKA2_2) * 180/pi
-    IKCoxaAngle_2 = 90 - atan2(NewPosY_2, NewPosX_2) * 180/pi
-    
-    NewPosX_3 = FeetPosX_3 + PosX +  BodyIKX_3
-    NewPosZ_3 = FeetPosZ_3 + PosZ + BodyIKZ_3
-    NewPosY_3 = FeetPosY_2 + PosY + BodyIKY_2
-    CoxaFeetDist_3 = sqrt(NewPosX_3**2   + NewPosY_3**2)
-    IKSW_3 = sqrt((CoxaFeetDist_3 - CoxaLength ) **2 + NewPosZ_3**2)
-    IKA1_3 = atan((CoxaFeetDist_3 - CoxaLength)/NewPosZ_3)
-    IKA2_3 = acos((TibiaLength**2 - FemurLength**2 - IKSW_3**2)/(-2 * IKSW_3 *  FemurLength))
-    TAngle_3 = acos((IKSW_3**2 - TibiaLength**2 - FemurLength**2)/(-2 * FemurLength * TibiaLength))
-    IKTibiaAngle_3 = 90 - TAngle_3 * 180/pi
-    IKFemurAngle_3 = 90 - (IKA1_3 + IKA2_3) * 180/pi
-    IKCoxaAngle_3 = 90 - atan2(NewPosY_3, NewPosX_3) * 180/pi
-    
-    NewPosX_4 = FeetPosX_4 + PosX +  BodyIKX_4
-    NewPosZ_4 = FeetPosZ_4 + PosYZ + BodyIKZ_4
-    NewPosY_4 = FeetPosY_4 + PosY + BodyIKY_4
-    CoxaFeetDist_4 = sqrt(NewPosX_4**2   + NewPosY_4**2)
-    IKSW_4 = sqrt((CoxaFeetDist_4 - CoxaLength ) **2 + NewPosZ_4**2)
-    IKA1_4 = atan((CoxaFeetDist_4 - CoxaLength)/NewPosZ_4)
-    IKA2_4 = acos((TibiaLength**2 - FemurLength**2 - IKSW_4**2)/(-2 * IKSW_4 *  FemurLength))
-    TAngle_4 = acos((IKSW_4**2 - TibiaLength**2 - FemurLength**2)/(-2 * FemurLength * TibiaLength))
-    IKTibiaAngle_4 = 90 - TAngle_4 * 180/pi
-    IKFemurAngle_4 = 90 - (IKA1_4 + IKA2_4) * 180/pi
-    IKCoxaAngle_4 = 90 - atan2(NewPosY_4, NewPosX_4) * 180/pi
-    
-    NewPosX_5 = FeetPosX_5 + PosX +  BodyIKX_5
-    NewPosZ_5 = FeetPosZ_5 + PosZ + BodyIKZ_5
-    NewPosY_5 = FeetPosY_5 + PosY + BodyIKY_5
-    CoxaFeetDist_5 = sqrt(NewPosX_5**2   + NewPosY_5**2)
-    IKSW_5 = sqrt((CoxaFeetDist_5 - CoxaLength ) **2 + NewPosZ_5**2)
-    IKA1_5 = atan((CoxaFeetDist_5 - CoxaLength)/NewPosZ_5)
-    IKA2_5 = acos((TibiaLength**2 - FemurLength**2 - IKSW_5**2)/(-2 * IKSW_5 *  FemurLength))
-    TAngle_5 = acos((IKSW_5**2 - TibiaLength**2 - FemurLength**2)/(-2 * FemurLength * TibiaLength))
-    IKTibiaAngle_5 = 90 - TAngle_5 * 180/pi
-    IKFemurAngle_5 = 90 - (IKA1_5 + IKA2_5) * 180/pi
-    IKCoxaAngle_5 = 90 - atan2(NewPosY_5, NewPosX_5) * 180/pi
-    
-    NewPosX_6 = FeetPosX_6 + PosX +  BodyIKX_6
-    NewPosZ_6 = FeetPosZ_6 + PosZ + BodyIKZ_6
-    NewPosY_6 = FeetPosY_6 + PosY + BodyIKY_6
-    CoxaFeetDist_6 = sqrt(NewPosX_6**2   + NewPosY_6**2)
-    IKSW_6 = sqrt((CoxaFeetDist_6 - CoxaLength ) **2 + NewPosZ_6**2)
-    IKA1_6 = atan((CoxaFeetDist_6 - CoxaLength)/NewPosZ_6)
-    IKA2_6 = acos((TibiaLength**2 - FemurLength**2 - IKSW_6**2)/(-2 * IKSW_6 *  FemurLength))
-    TAngle_6 = acos((IKSW_6**2 - TibiaLength**2 - FemurLength**2)/(-2 * FemurLength * TibiaLength))
-    IKTibiaAngle_6 = 90 - TAngle_6 * 180/pi
-    IKFemurAngle_6 = 90 - (IKA1_6 + IKA2_6) * 180/pi
-    IKCoxaAngle_6 = 90 - atan2(NewPosY_6, NewPosX_6) * 180/pi
-    
-    # Servo angles
-    
-    CoxaAngle_1 = IKCoxaAngle_1 - 60
-    FemurAngle_1 = IKFemurAngle_1
-    TibiaAngle_1 = IKTibiaAngle_1
-    
-    CoxaAngle_2 = IKCoxaAngle_2
-    FemurAngle_2 = IKFemurAngle_2
-    TibiaAngle_2 = IKTibiaAngle_2
-    
-    CoxaAngle_3 = IKCoxaAngle_3 + 60
-    FemurAngle_3 = IKFemurAngle_3
-    TibiaAngle_3 = IKTibiaAngle_3
-    
-    CoxaAngle_4 = IKCoxaAngle_4 - 240
-    FemurAngle_4 = IKFemurAngle_4
-    TibiaAngle_4 = IKTibiaAngle_4
-    
-    CoxaAngle_5 = IKCoxaAngle_5 - 180
-    FemurAngle_5 = IKFemurAngle_5
-    TibiaAngle_5 = IKTibiaAngle_5
-    
-    CoxaAngle_6 = IKCoxaAngle_6 - 120
-    FemurAngle_6 = IKFemurAngle_6
-    TibiaAngle_6 = IKTibiaAngle_6
+    PosX/PosY/PosZ shift the body right/forward/up in mm; RotX, RotY and
+    RotZ pitch it nose-up, roll it right-side-down and turn it anticlockwise
+    from above, in degrees. Positive coxa angles swing a foot forward, as
+    in right_forward().
+    """
+    sx, cx = sin(RotX*pi/180), cos(RotX*pi/180)
+    sy, cy = sin(RotY*pi/180), cos(RotY*pi/180)
+    sz, cz = sin(RotZ*pi/180), cos(RotZ*pi/180)
+    # feet in body coordinates: undo the translation, then yaw, roll and pitch
+    x, y, z = FEET[:, 0] - PosX, FEET[:, 1] - PosY, FEET[:, 2] - PosZ
+    x, y = cz*x + sz*y, -sz*x + cz*y
+    x, z = cy*x - sy*z, sy*x + cy*z
+    y, z = cx*y + sx*z, -sx*y + cx*z
+    return {servo: float(angle) for servo, angle in solve_feet(x, y, z).items()}
 
 def right_up():
+    angles = {}
     for leg in [0, 3, 4]:
-        move(tibia[leg], height )
-        move(patella[leg], -130 )
-    time.sleep(delay)
+        angles[tibia[leg]] = height
+        angles[patella[leg]] = -130
+    pose(angles, delay)
+    pause(delay, angles)
 def right_down():
+    angles = {}
     for leg in [0, 3, 4]:
-        move(tibia[leg], 30 )
-        move(patella[leg], -120 )
-    time.sleep(delay)
+        angles[tibia[leg]] = 30
+        angles[patella[leg]] = -120
+    pose(angles, delay)
+    pause(delay, angles)
 def left_up():
+    angles = {}
     for leg in [1, 2, 5]:
-        move(tibia[leg], height )
-        move(patella[leg], -130 )
-    time.sleep(delay)
+        angles[tibia[leg]] = height
+        angles[patella[leg]] = -130
+    pose(angles, delay)
+    pause(delay, angles)
 def left_down():
+    angles = {}
     for leg in [1, 2, 5]:
-        move(tibia[leg], 30 )
-        move(patella[leg], -120 )
-    time.sleep(delay)
+        angles[tibia[leg]] = 30
+        angles[patella[leg]] = -120
+    pose(angles, delay)
+    pause(delay, angles)
 def right_forward(d):
+    angles = {}
     for leg in [0, 3, 4]:
-        move(coxa[leg], forward*d)
-    time.sleep(delay)
+        angles[coxa[leg]] = forward*d
+    pose(angles, delay)
+    pause(delay, angles)
 def right_back(d):
+    angles = {}
     for leg in [0, 3, 4]:
-        move(coxa[leg], -forward*d)
-    time.sleep(delay)
+        angles[coxa[leg]] = -forward*d
+    pose(angles, delay)
+    pause(delay, angles)
 def left_forward(d):
+    angles = {}
     for leg in [1, 2, 5]:
-        move(coxa[leg], forward*d)
-    time.sleep(delay)
+        angles[coxa[leg]] = forward*d
+    pose(angles, delay)
+    pause(delay, angles)
 def left_back(d):
+    angles = {}
     for leg in [1, 2, 5]:
-        move(coxa[leg], -forward*d)
-    time.sleep(delay)
+        angles[coxa[leg]] = -forward*d
+    pose(angles, delay)
+    pause(delay, angles)
 def right_rotate(d):
+    angles = {}
     for leg in [0, 4]:
-        move(coxa[leg], forward*d)
-    move(coxa[3], -forward*d)
-    time.sleep(delay)
+        angles[coxa[leg]] = forward*d
+    angles[coxa[3]] = -forward*d
+    pose(angles, delay)
+    pause(delay, angles)
 def left_rotate(d):
+    angles = {}
     for leg in [1, 5]:
-        move(coxa[leg], -forward*d)
-    move(coxa[2], forward*d)
-    time.sleep(delay)
+        angles[coxa[leg]] = -forward*d
+    angles[coxa[2]] = forward*d
+    pose(angles, delay)
+    pause(delay, angles)
 
 
 delay = 0.1
@@ -357,99 +324,684 @@ def turn(d):
     right_rotate(-d)
     left_down()
 
-def dance():
+# Smooth gaits: the feet follow trajectory.plan() curves scaled to the gait
+# parameters, solved for a whole cycle at once and sent one pose() per tick.
+TRAJECTORY_TICK = 0.02
+TRAJECTORY_SHAPE = 'cycloid'
+
+@functools.lru_cache(maxsize=32)
+def gait_table(forward, height, delay, d, turning, shape):
+    """Per-tick {servo: angle} for one smooth walk (or turn) cycle.
+
+    A cycle lasts as long as dowalk()'s eight phases. The stride covers the
+    same coxa sweep as the stepped gaits and the feet rise as high as
+    tibia `height` lifts them along a trajectory.SHAPES `shape`; d=1 walks
+    forward or turns clockwise.
+    """
+    along, up = trajectory.plan(8*delay, TRAJECTORY_TICK, shape)
+    lift = _foot(height, -130)[1] - STAND_HEIGHT
+    z = FEET[:, 2] + lift*up
+    if turning:
+        # feet circle the body centre, sliding anticlockwise in stance to turn it clockwise
+        angle = np.radians(-2*forward*d*along)
+        x = FEET[:, 0]*np.cos(angle) - FEET[:, 1]*np.sin(angle)
+        y = FEET[:, 0]*np.sin(angle) + FEET[:, 1]*np.cos(angle)
+    else:
+        stride = 2*STAND_REACH*sin(forward*pi/180)
+        x = np.broadcast_to(FEET[:, 0], along.shape)
+        y = FEET[:, 1] + stride*d*along
+    angles = solve_feet(x, y, z)
+    return [{servo: float(angles[servo][tick]) for servo in angles} for tick in range(len(along))]
+
+def glide(d):
+    """One walk cycle with the feet on smooth trajectories."""
+    for angles in gait_table(forward, height, delay, d, False, TRAJECTORY_SHAPE):
+        pose(angles, TRAJECTORY_TICK)
+        pause(TRAJECTORY_TICK)
+
+def swivel(d):
+    """One turning cycle with the feet on smooth trajectories."""
+    for angles in gait_table(forward, height, delay, d, True, TRAJECTORY_SHAPE):
+        pose(angles, TRAJECTORY_TICK)
+        pause(TRAJECTORY_TICK)
+
+CPG_TICK = 0.02
+
+def oscillate(oscillators, seconds, tick=CPG_TICK):
+    """Send all 18 servos the output of a cpg.Oscillators bank, one bulk frame per tick."""
+    control.setSpeeds({pin: 0 for pin in PINS})
+    start = control.clock()
+    due = start
+    while due - start < seconds:
+        targets = (HOMES + oscillators.step(tick)*STEPS).astype(int)
+        control.setTargets(dict(zip(PINS, targets.tolist())))
+        # keep to the tick schedule however long the frame took
+        due += tick
+        control.sleep(max(0, due - control.clock()))
+
+def dance(seconds=10):
+    """Sway the body from one tripod while the other waves."""
+    bank = cpg.Oscillators(18)
+    offset = np.zeros(18)
+    amplitude = np.zeros(18)
+    frequency = np.zeros(18)
     for leg in [0, 3, 4]:
-        move(coxa[leg], 0)
-        move(tibia[leg], 30 )
-        move(patella[leg], -120 )
+        offset[tibia[leg]] = 30
+        offset[patella[leg]] = -120
     for leg in [1, 2, 5]:
-        move(coxa[leg], 0)
-        move(tibia[leg], 50 )
-    x = 0
-    delay = 0.1
-    while x < 10:
-        for leg in [1,2,5]:
-            move(tibia[leg], 50+sin(x/3*2*pi)*10)
-            move(patella[leg], -50+sin(x/3*2*pi)*40)
-        for leg in [0,2,4]:
-            move(coxa[leg], sin(x/4*2*pi)*5)
-        for leg in [1,3,5]:
-            move(coxa[leg], -sin(x/4*2*pi)*5)
-        time.sleep(delay)
-        x += delay
-
+        offset[tibia[leg]], amplitude[tibia[leg]], frequency[tibia[leg]] = 50, 10, 1/3
+        offset[patella[leg]], amplitude[patella[leg]], frequency[patella[leg]] = -50, 40, 1/3
+    for leg in range(6):
+        amplitude[coxa[leg]] = 5 if leg % 2 == 0 else -5
+        frequency[coxa[leg]] = 1/4
+    # take up the rest pose at once and sway in over a second
+    bank.set(offset=offset, frequency=frequency)
+    bank.set(1.0, amplitude=amplitude)
+    oscillate(bank, seconds)
 
 def stand():
     for leg in range(6):
-        move(coxa[leg], 0)
-        move(tibia[leg], 29.3)
-        move(patella[leg], -(180-60.7))
-        time.sleep(1)
+        pose({coxa[leg]: 0, tibia[leg]: 29.3, patella[leg]: -(180-60.7)})
+        pause(1)
 
 def compact():
+    angles = {}
     for leg in [2,3]:
-        move(coxa[leg], 0)
+        angles[coxa[leg]] = 0
     for leg in [0,1]:
-        move(coxa[leg], 20)
+        angles[coxa[leg]] = 20
     for leg in [4,5]:
-        move(coxa[leg], -20)
+        angles[coxa[leg]] = -20
     for leg in range(6):
-        move(tibia[leg], 75)
-        move(patella[leg], -155)
+        angles[tibia[leg]] = 75
+        angles[patella[leg]] = -155
+    pose(angles)
+
+def play(motion, *args):
+    """Run a motion from its precompiled serial frames (see primitives.py)."""
+    primitives.load(sys.modules[__name__], motion.__name__, *args).play(control, pause)
+
+# walking commands repeat until another command arrives; EPOCHE_SMOOTH=1
+# walks on planned foot trajectories instead of the stepped phases
+WALK, TURN = (glide, swivel) if os.environ.get('EPOCHE_SMOOTH') else (dowalk, turn)
+GAITS = {
+    'forward': (WALK, 1),
+    'back': (WALK, -1),
+    'right': (TURN, 1),
+    'left': (TURN, -1),
+}
+# walking gaits in Maestro script subroutine order (see gaitscript.py)
+SCRIPTED = [(gait.__name__, (d,)) for gait, d in GAITS.values()]
+# the host heartbeats its current mode; stop walking if it goes quiet this long
+LINK_TIMEOUT = 2.0
+
+# In 'body' mode the host streams (x, y, z, pitch, roll, yaw) setpoints for
+# calculate_servo_angles to this port as packed floats, as fast as it likes.
+POSE_PORT = 15790
+POSE = struct.Struct('<6f')
+BODY_TICK = 0.02
+
+class BodyStream:
+    """Body-pose setpoints from the host, of which only the latest is solved and sent each tick."""
+
+    def __init__(self, context, port=POSE_PORT):
+        self.socket = context.socket(zmq.SUB)
+        # keep only the newest message, so a burst of setpoints costs one solve
+        self.socket.setsockopt(zmq.CONFLATE, 1)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self.socket.bind('tcp://*:{}'.format(port))
+        self.setpoint = None
+        self.sent = None
+
+    def resume(self):
+        """Send the latest setpoint again on the next tick: other modes have moved the legs since."""
+        self.sent = None
+
+    def tick(self):
+        try:
+            self.setpoint = POSE.unpack(self.socket.recv(zmq.NOBLOCK))
+        except zmq.Again:
+            pass
+        if self.setpoint is not None and self.setpoint != self.sent:
+            pose(calculate_servo_angles(*self.setpoint), BODY_TICK)
+            self.sent = self.setpoint
+
+# In 'offload' mode the host plans the gait and solves the IK itself (see
+# host/offload.py) and streams finished frames to this port: a sequence
+# number, the time on the robot's clock to apply the frame at (0 for on
+# arrival; see clocksync.py), the onboard gait to fall back to (an index
+# into GAITS, or NO_FALLBACK) and a Maestro target for each of the 18 servos
+# in servo order (0 leaves a servo where it is).
+OFFLOAD_PORT = 15791
+TARGET_FRAME = struct.Struct('<IdB18H')
+NO_FALLBACK = 255
+# walk the fallback gait once frames stop for this long
+OFFLOAD_TIMEOUT = 0.25
+OFFLOAD_POLL = 0.005
+# targets outside this servo pulse range (quarter-microseconds), or outside
+# the controller's ranges where they are set, are refused
+TARGET_RANGE = (500*4, 2500*4)
+
+class FrameStream:
+    """Ready-made servo frames from the host, checked against the servo limits and sent when due."""
+
+    def __init__(self, context, port=OFFLOAD_PORT):
+        self.socket = context.socket(zmq.SUB)
+        # room for the frames scheduled ahead, not for a backlog
+        self.socket.setsockopt(zmq.RCVHWM, 100)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self.socket.bind('tcp://*:{}'.format(port))
+        mins = np.array([control.Mins[pin] for pin in PINS])
+        maxs = np.array([control.Maxs[pin] for pin in PINS])
+        self.lows = np.maximum(TARGET_RANGE[0], mins)
+        self.highs = np.where(maxs > 0, np.minimum(TARGET_RANGE[1], maxs), TARGET_RANGE[1])
+        self.schedule = clocksync.Schedule()
+        self.sequence = None
+        self.received = None  # when the last good frame arrived
+        self.live = False  # frames are being sent
+        self.started = False  # frames were sent before, so the next ones resume the stream
+        self.fallback = None
+
+    def check(self, data):
+        """The frame's (sequence, time, fallback, targets), or None with a reason printed if it is unusable."""
+        if len(data) != TARGET_FRAME.size:
+            print('Offload frame of {} bytes ignored'.format(len(data)))
+            return None
+        sequence, at, fallback, *targets = TARGET_FRAME.unpack(data)
+        targets = np.array(targets)
+        bad = (targets != 0) & ((targets < self.lows) | (targets > self.highs))
+        if bad.any():
+            servo = int(np.flatnonzero(bad)[0])
+            print('Offload frame {} ignored: servo {} target {} outside {}-{}'.format(
+                sequence, servo, targets[servo], int(self.lows[servo]), int(self.highs[servo])))
+            return None
+        if fallback != NO_FALLBACK and fallback >= len(GAITS):
+            print('Offload frame {} ignored: no gait {}'.format(sequence, fallback))
+            return None
+        return sequence, at, fallback, targets
+
+    def wait(self):
+        """Seconds to the next tick: the poll interval, or sooner if a frame falls due."""
+        waiting = self.schedule.wait()
+        return OFFLOAD_POLL if waiting is None else min(waiting, OFFLOAD_POLL)
+
+    def tick(self):
+        """Send the newest frame that is due; return the gait to walk onboard if the stream has stalled."""
+        while True:
+            try:
+                frame = self.check(self.socket.recv(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+            if frame is None:
+                continue
+            sequence, at, fallback, targets = frame
+            if self.sequence is not None and sequence > self.sequence + 1:
+                metrics.count('offload.dropped', sequence - self.sequence - 1)
+            metrics.count('offload.frames')
+            self.sequence = sequence
+            self.fallback = None if fallback == NO_FALLBACK else list(GAITS)[fallback]
+            self.received = time.monotonic()
+            self.schedule.push(targets, at or None)
+        due = self.schedule.due()
+        if due:
+            # a frame already overtaken by a newer one would only be a twitch
+            metrics.count('offload.skipped', len(due) - 1)
+            self.send(due[-1])
+        stalled = self.received is None or time.monotonic() - self.received > OFFLOAD_TIMEOUT
+        if stalled and self.live:
+            print('Offload stream stalled, falling back to {}.'.format(self.fallback or 'holding still'))
+            self.live = False
+            self.schedule = clocksync.Schedule()
+        return self.fallback if stalled else None
+
+    def send(self, targets):
+        if not self.live:
+            if self.started:
+                print('Offload stream resumed.')
+            # take over from whatever speeds the onboard gait left
+            control.setSpeeds({pin: 0 for pin in PINS})
+            self.live = True
+            self.started = True
+        control.setTargets({PINS[servo]: int(target) for servo, target in enumerate(targets) if target})
+
+# 'macro STEP; STEP; ...' runs a whole maneuver from one command, with no
+# round trip to the host between steps. A step is a GAITS mode and a number
+# of cycles (at least 1, the default), 'stand' or 'compact', 'pause
+# SECONDS', or NAME=VALUE to set delay, forward or height (within
+# MACRO_PARAMETERS) for the steps after it (and after the macro, as 'faster'
+# and the like would). A step out of range refuses the whole macro. Progress
+# is published to this port as it goes: 'macro N step I/COUNT STEP' as each
+# step starts, then 'macro N done', or 'macro N aborted' when a command
+# changes the mode first. Parameter commands leave a running macro be.
+PROGRESS_PORT = 15792
+# ranges a macro may set the gait parameters to; every gait keeps its
+# servo targets inside TARGET_RANGE across them
+MACRO_PARAMETERS = {'delay': (0.02, 1.0), 'forward': (1, 45), 'height': (10, 80)}
+MACRO_POSES = ('stand', 'compact')
+
+def is_macro(command):
+    """Whether a host command is a 'macro' one (and not, say, 'macros')."""
+    return command.split(' ', 1)[0] == 'macro'
+
+def parse_macro(command):
+    """The (verb, argument, text) steps of a 'macro' command; ValueError if one is bad."""
+    steps = []
+    for text in command.partition(' ')[2].split(';'):
+        text = text.strip()
+        words = text.split()
+        if not words:
+            continue
+        verb = words[0]
+        if len(words) == 1 and '=' in verb:
+            name, value = verb.split('=', 1)
+            if name not in MACRO_PARAMETERS:
+                raise ValueError('unknown parameter {}'.format(name))
+            value = float(value)
+            low, high = MACRO_PARAMETERS[name]
+            if not low <= value <= high:
+                raise ValueError('{} must be {}-{}'.format(name, low, high))
+            steps.append(('set', (name, value), text))
+        elif verb in GAITS and len(words) <= 2:
+            cycles = int(words[1]) if len(words) == 2 else 1
+            if cycles < 1:
+                raise ValueError('{} needs at least one cycle'.format(verb))
+            steps.append((verb, cycles, text))
+        elif verb in MACRO_POSES and len(words) == 1:
+            steps.append((verb, None, text))
+        elif verb == 'pause' and len(words) == 2:
+            seconds = float(words[1])
+            if not (isfinite(seconds) and seconds >= 0):
+                raise ValueError('pause must be 0 or more seconds')
+            steps.append((verb, seconds, text))
+        else:
+            raise ValueError('bad step {!r}'.format(text))
+    if not steps:
+        raise ValueError('empty macro')
+    return steps
+
+class Macro:
+    """A running macro, handed out one gait cycle, pose or pause at a time.
+
+    progress is the PUB socket to report to, or None to report nowhere.
+    """
+
+    def __init__(self, number, steps, progress):
+        self.number = number
+        self.steps = steps
+        self.progress = progress
+        self.step = -1
+        self.remaining = 0  # units left in the current step
+
+    def report(self, text):
+        if self.progress is not None:
+            self.progress.send_string('macro {} {}'.format(self.number, text))
+
+    def next(self):
+        """The next unit, ('play', motion, args) or ('pause', seconds); None once the macro is done."""
+        while self.remaining <= 0:
+            self.step += 1
+            if self.step == len(self.steps):
+                self.report('done')
+                return None
+            verb, argument, text = self.steps[self.step]
+            self.report('step {}/{} {}'.format(self.step + 1, len(self.steps), text))
+            if verb == 'set':
+                name, value = argument
+                globals()[name] = value
+            elif verb in GAITS:
+                self.remaining = argument
+            else:
+                self.remaining = 1
+        self.remaining -= 1
+        verb, argument, text = self.steps[self.step]
+        if verb in GAITS:
+            gait, d = GAITS[verb]
+            return 'play', gait, (d,)
+        if verb == 'pause':
+            return 'pause', argument
+        return 'play', globals()[verb], ()
+
+    def abort(self):
+        self.report('aborted')
+
+def handle(command, mode):
+    """Apply one host command; return the walking mode that follows it."""
+    global delay, forward, height
+
+    x = command
+
+    if x == 'q':
+        return 'paused'
+    if x in GAITS or x in ('paused', 'body', 'offload'):
+        return x
+    if is_macro(x):
+        return 'macro'
+    if x == 'slower':
+        delay /= 1.2
+    if x == 'faster':
+        delay *= 1.2
+    if x == 'more':
+        forward /= 1.2
+    if x == 'less':
+        forward *= 1.2
+    if x == 'lower':
+        height /= 1.2
+    if x == 'higher':
+        height *= 1.2
+    return mode
+
+def stats():
+    """Reply to the host's 'stats' command: command latencies and the IK cache hit rate."""
+    return '{}\n{:>16}: {}'.format(tracer.dump(), 'ik cache', calculate_servo_angles.summary())
+
+def answer(command):
+    """Reply to a host command: stats, 'error: ...' for a macro that won't parse, or 'ack'."""
+    if command == 'stats':
+        return stats()
+    if is_macro(command):
+        try:
+            parse_macro(command)
+        except ValueError as e:
+            return 'error: {}'.format(e)
+    return 'ack'
 
 def run():
-    """Main loop."""
+    """Main loop.
+
+    Set EPOCHE_RECORD to a file name to log every command and servo byte
+    (see recorder.py). Set EPOCHE_ONBOARD once the controller holds the
+    gaitscript.py script: walking then only starts and stops its
+    subroutines. The script keeps the parameters it was compiled with, so
+    reprogram it after changing them. The 'body' command holds the feet and
+    moves the body to the setpoints streamed to POSE_PORT (see BodyStream);
+    'offload' plays the frames streamed to OFFLOAD_PORT (see FrameStream),
+    walking the gait they name onboard whenever they stop coming. Commands
+    marked with a time run then (see clocksync.py), though while walking
+    only at the end of a cycle, when commands are read; 'sync' is answered
+    for the host's clock estimate, which drops replies held up that way.
+    Macros run to the end whether or not the host keeps in touch,
+    reporting to PROGRESS_PORT (see Macro).
+    """
 
     command_port = 15787
     context = zmq.Context()
     host = context.socket(zmq.REP)
     host.bind('tcp://*:{}'.format(command_port))
+    body = BodyStream(context)
+    offload = FrameStream(context)
+    progress = context.socket(zmq.PUB)
+    progress.bind('tcp://*:{}'.format(PROGRESS_PORT))
+    if metrics.enabled:
+        metrics.serve()
+    log = None
+    if os.environ.get('EPOCHE_RECORD'):
+        log = recorder.Recorder(os.environ['EPOCHE_RECORD'])
+        control.writeHooks.append(log.serial)
+    onboard = bool(os.environ.get('EPOCHE_ONBOARD'))
+    # map the gaits for the starting parameters before the first command
+    if not onboard:
+        for gait, d in GAITS.values():
+            primitives.load(sys.modules[__name__], gait.__name__, d)
 
+    mode = 'paused'
+    running = 'paused' # gait the controller's script is playing
+    schedule = clocksync.Schedule()
+    macro = None
+    macros = 0
+    heard = time.monotonic()
     done = False
     while not done:
-        print('Waiting for command...')
-        command = host.recv_string().strip()
-        print('Received from host: {}'.format(command))
-        host.send_string('ack')
-
-        time.sleep(1)
-
-        if command == 'q':
-            done = True
-            command_queue.put('q')
-            print('Exiting...')
-    
-        x = command
-
-        if x == 'forward':
-            dowalk(1)
-        if x == 'back':
-            dowalk(-1)
-        if x == 'right':
-            turn(1)
-        if x == 'left':
-            turn(-1)
-        if x == 'slower':
-            delay /= 1.2
-            x = ' '
-        if x == 'faster':
-            delay *= 1.2
-            x = ' '
-        if x == 'more':
-            forward /= 1.2
-            x = ' '
-        if x == 'less':
-            forward *= 1.2
-            x = ' '
-        if x == 'lower':
-            height /= 1.2
-            x = ' '
-        if x == 'higher':
-            height *= 1.2
-            x = ' '
-
-
-        time.sleep(0.001)
+        walking = mode in GAITS
+        waiting = schedule.wait()
+        if not walking and mode not in ('body', 'offload', 'macro') and waiting is None:
+            print('Waiting for command...')
+        # between walk cycles only check for news; otherwise block until the host speaks
+        if walking and onboard:
+            timeout = LINK_TIMEOUT*1000
+        elif walking or mode == 'macro':
+            timeout = 0
+        elif mode == 'body':
+            timeout = BODY_TICK*1000
+        elif mode == 'offload':
+            timeout = offload.wait()*1000
+        else:
+            timeout = None
+        # or until the next scheduled command is due
+        if waiting is not None and (timeout is None or waiting*1000 < timeout):
+            timeout = waiting*1000
+        if host.poll(timeout):
+            received = time.monotonic()
+            message, trace_id = metrics.untag(host.recv_string().strip())
+            command, at = clocksync.unschedule(message)
+            heard = received
+            if command == 'sync':
+                host.send_string(clocksync.reply(received))
+                continue
+            if trace_id is not None:
+                tracer.begin(trace_id)
+            print('Received from host: {}'.format(message))
+            reply = answer(command)
+            host.send_string(reply)
+            if not reply.startswith('error'):
+                schedule.push(command, at)
+        elif (walking or mode == 'offload') and time.monotonic() - heard > LINK_TIMEOUT:
+            print('Lost contact with host, stopping.')
+            mode = 'paused'
+
+        for command in schedule.due():
+            if log is not None:
+                log.command(command)
+            previous = mode
+            mode = handle(command, mode)
+            if mode == 'body' and previous != 'body':
+                body.resume()
+            if macro is not None and (mode != 'macro' or is_macro(command)):
+                macro.abort()
+                macro = None
+            if is_macro(command):
+                try:
+                    steps = parse_macro(command)
+                except ValueError as e:
+                    print('Macro refused: {}'.format(e))
+                    mode = 'paused'
+                else:
+                    macros += 1
+                    macro = Macro(macros, steps, progress)
+            if command == 'q':
+                done = True
+                print('Exiting...')
+
+        # the gait to walk onboard: the commanded one, or the offload fallback
+        gait_mode = mode
+        if mode == 'offload':
+            gait_mode = offload.tick() or mode
+        if onboard:
+            if gait_mode != running:
+                if gait_mode in GAITS:
+                    tracer.stamp('gait')
+                    control.runScriptSub(list(GAITS).index(gait_mode))
+                else:
+                    control.stopScript()
+                running = gait_mode
+        elif gait_mode in GAITS:
+            gait, d = GAITS[gait_mode]
+            tracer.stamp('gait')
+            play(gait, d)
+        if mode == 'body':
+            body.tick()
+        if mode == 'macro':
+            unit = macro.next()
+            if unit is None:
+                macro = None
+                mode = 'paused'
+            elif unit[0] == 'play':
+                tracer.stamp('gait')
+                play(unit[1], *unit[2])
+            else:
+                pause(unit[1])
+
+    if log is not None:
+        log.close()
+
+
+async def run_async():
+    """run() on one asyncio event loop.
+
+    Commands arrive through zmq.asyncio and the gait runs as its own task,
+    writing through a maestro.AsyncController, so serial writes and settle
+    polls overlap with receiving commands instead of blocking them. A new
+    command takes effect at the end of the current walk cycle, as in run().
+    EPOCHE_RECORD, EPOCHE_ONBOARD, scheduled commands and macros work as
+    they do there; EPOCHE_PIPELINE does not (see maestro.AsyncController).
+    """
+    import zmq.asyncio
+
+    command_port = 15787
+    context = zmq.asyncio.Context()
+    host = context.socket(zmq.REP)
+    host.bind('tcp://*:{}'.format(command_port))
+    body = BodyStream(zmq.Context.instance())
+    offload = FrameStream(zmq.Context.instance())
+    progress = zmq.Context.instance().socket(zmq.PUB)
+    progress.bind('tcp://*:{}'.format(PROGRESS_PORT))
+    if metrics.enabled:
+        metrics.serve()
+    log = None
+    if os.environ.get('EPOCHE_RECORD'):
+        log = recorder.Recorder(os.environ['EPOCHE_RECORD'])
+        control.writeHooks.append(log.serial)
+    onboard = bool(os.environ.get('EPOCHE_ONBOARD'))
+    if not onboard:
+        for gait, d in GAITS.values():
+            primitives.load(sys.modules[__name__], gait.__name__, d)
+
+    actuator = maestro.AsyncController(control)
+    actuator.start()
+    state = {'mode': 'paused', 'done': False, 'macro': None, 'macros': 0}
+    changed = asyncio.Event()
+    schedule = clocksync.Schedule()
+    pushed = asyncio.Event()
+
+    async def settle(seconds, servos=None):
+        if servos:
+            await actuator.wait_until_settled([servo_info[servo]['pin'] for servo in servos], SETTLE_TIMEOUT*seconds)
+        else:
+            await asyncio.sleep(seconds)
+
+    async def receive():
+        while not state['done']:
+            walking = state['mode'] in GAITS or state['mode'] == 'offload'
+            if not walking and state['mode'] not in ('body', 'macro'):
+                print('Waiting for command...')
+            try:
+                message = await asyncio.wait_for(host.recv_string(), LINK_TIMEOUT if walking else None)
+            except asyncio.TimeoutError:
+                print('Lost contact with host, stopping.')
+                state['mode'] = 'paused'
+                changed.set()
+                continue
+            received = time.monotonic()
+            message, trace_id = metrics.untag(message.strip())
+            command, at = clocksync.unschedule(message)
+            if command == 'sync':
+                await host.send_string(clocksync.reply(received))
+                continue
+            if trace_id is not None:
+                tracer.begin(trace_id)
+            print('Received from host: {}'.format(message))
+            reply = answer(command)
+            await host.send_string(reply)
+            if reply.startswith('error'):
+                continue
+            schedule.push(command, at)
+            pushed.set()
+            if command == 'q':
+                break
+
+    async def dispatch():
+        # run each command when it falls due
+        while not state['done']:
+            for command in schedule.due():
+                if log is not None:
+                    log.command(command)
+                previous = state['mode']
+                state['mode'] = handle(command, state['mode'])
+                if state['mode'] == 'body' and previous != 'body':
+                    body.resume()
+                if state['macro'] is not None and (state['mode'] != 'macro' or is_macro(command)):
+                    state['macro'].abort()
+                    state['macro'] = None
+                if is_macro(command):
+                    try:
+                        steps = parse_macro(command)
+                    except ValueError as e:
+                        print('Macro refused: {}'.format(e))
+                        state['mode'] = 'paused'
+                    else:
+                        state['macros'] += 1
+                        state['macro'] = Macro(state['macros'], steps, progress)
+                if command == 'q':
+                    state['done'] = True
+                    print('Exiting...')
+                changed.set()
+            pushed.clear()
+            # receive() has stopped after 'q', so nothing more will be pushed
+            if state['done']:
+                break
+            try:
+                await asyncio.wait_for(pushed.wait(), schedule.wait())
+            except asyncio.TimeoutError:
+                pass
+
+    async def walk():
+        running = 'paused'
+        while not state['done']:
+            mode = state['mode']
+            if mode == 'offload':
+                mode = offload.tick() or mode
+            if onboard:
+                if mode != running:
+                    if mode in GAITS:
+                        tracer.stamp('gait')
+                        control.runScriptSub(list(GAITS).index(mode))
+                    else:
+                        control.stopScript()
+                    running = mode
+            elif mode in GAITS:
+                gait, d = GAITS[mode]
+                tracer.stamp('gait')
+                await primitives.load(sys.modules[__name__], gait.__name__, d).play_async(control, settle)
+                continue
+            if mode == 'body':
+                body.tick()
+                await asyncio.sleep(BODY_TICK)
+                continue
+            if mode == 'macro':
+                macro = state['macro']
+                unit = macro.next()
+                if unit is None:
+                    if state['macro'] is macro:
+                        state['macro'] = None
+                        state['mode'] = 'paused'
+                elif unit[0] == 'play':
+                    tracer.stamp('gait')
+                    await primitives.load(sys.modules[__name__], unit[1].__name__, *unit[2]).play_async(control, settle)
+                else:
+                    await asyncio.sleep(unit[1])
+                continue
+            if state['mode'] == 'offload':
+                await asyncio.sleep(offload.wait())
+                continue
+            changed.clear()
+            await changed.wait()
+
+    try:
+        await asyncio.gather(receive(), dispatch(), walk())
+        await actuator.drain()
+    finally:
+        actuator.stop()
+        if log is not None:
+            log.close()
 
 
 if __name__=='__main__':
@@ -458,6 +1010,7 @@ if __name__=='__main__':
     #right_up()
     #dance()
     #run()
+    #asyncio.run(run_async())
     #for x in range(5):
         #turn(1)
     #    dowalk(-1)
@@ -465,5 +1018,7 @@ if __name__=='__main__':
     #for x in [0,1,4,5]:
     #    move(tibia[x], 30)
     #    move(patella[x], -90)
+    if pipeline is not None:
+        pipeline.close()
     control.close()
 
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+"""Compile gaits into Maestro script subroutines.
+
+A gait's serial frames (see primitives.capture) are turned back into servo,
+speed and acceleration commands with the pauses as delays, and each gait
+becomes one subroutine that loops forever. Once the script is on the
+controller, Controller.runScriptSub(n) starts gait n and stopScript() ends
+it, so steady walking needs no host computation or serial traffic.
+
+Two forms are produced. The source text is what goes onto the controller:
+the Maestro's script memory is only writable over its native USB interface,
+so program it with Pololu's tools (`UscCmd --program gaits.txt` or the
+Maestro Control Center). The bytecode follows Pololu's compiler (opcodes
+below) and is what SimulatedSerial.loadScript runs, so compiled gaits can
+be checked against the simulator; its length is also the script size.
+
+Usage: gaitscript.py [FILE]   write the walking gaits for the current parameters
+"""
+
+import struct
+import sys
+import primitives
+
+# Maestro script opcodes
+QUIT = 0
+LITERAL = 32
+LITERAL8 = 33
+JUMP = 37
+DELAY = 39
+SERVO = 73
+SPEED = 75
+ACCELERATION = 76
+
+# Pololu serial commands and the script instructions they become
+INSTRUCTIONS = {0x04: ('servo', SERVO), 0x07: ('speed', SPEED), 0x09: ('acceleration', ACCELERATION)}
+
+def commands(data):
+    """Yield (command, channel, value) for each channel command in Pololu protocol bytes."""
+    i = 0
+    while i < len(data):
+        if data[i] != 0xaa:
+            raise ValueError('Expected Pololu lead-in at byte {}'.format(i))
+        op = data[i+2]
+        if op in INSTRUCTIONS:
+            yield op, data[i+3], data[i+4] + (data[i+5] << 7)
+            i += 6
+        elif op == 0x1f:
+            count, first = data[i+3], data[i+4]
+            for n in range(count):
+                yield 0x04, first+n, data[i+5+2*n] + (data[i+6+2*n] << 7)
+            i += 5 + 2*count
+        else:
+            raise ValueError('Cannot script Pololu command 0x{:02x}'.format(op))
+
+def literal(value):
+    if 0 <= value < 256:
+        return bytes([LITERAL8, value])
+    return bytes([LITERAL]) + struct.pack('<h', value)
+
+class Script:
+    """Maestro script source and bytecode for a list of looping gaits."""
+
+    def __init__(self):
+        self.source = ['# generated by gaitscript.py', 'quit', '']
+        # script body: stop straight away if the controller runs the script on startup
+        self.bytecode = bytearray([QUIT])
+        self.subroutines = []  # bytecode address of each subroutine
+        self.names = []
+
+    def add(self, name, frames):
+        """Append a subroutine that repeats `frames` forever; return its number."""
+        self.names.append(name)
+        self.subroutines.append(len(self.bytecode))
+        start = len(self.bytecode)
+        self.source.append('sub {}'.format(name))
+        self.source.append('  begin')
+        for data, seconds, servos, targets in frames:
+            for op, channel, value in commands(bytes(data)):
+                word, opcode = INSTRUCTIONS[op]
+                self.source.append('    {} {} {}'.format(value, channel, word))
+                self.bytecode += literal(value) + literal(channel) + bytes([opcode])
+            ms = int(round(seconds*1000))
+            if ms:
+                self.source.append('    {} delay'.format(ms))
+                self.bytecode += literal(ms) + bytes([DELAY])
+        self.source.append('  repeat')
+        self.source.append('')
+        self.bytecode += bytes([JUMP]) + struct.pack('<H', start)
+        return len(self.subroutines) - 1
+
+def compile(module, motions):
+    """Script with one looping subroutine per (name, args) motion of module."""
+    script = Script()
+    for name, args in motions:
+        frames, targets, speeds = primitives.capture(module, name, args)
+        label = '_'.join([name] + [str(a).replace('-', 'm') for a in args])
+        script.add(label, frames)
+    return script
+
+if __name__ == '__main__':
+    import epoche
+    script = compile(epoche, epoche.SCRIPTED)
+    output = open(sys.argv[1], 'w') if len(sys.argv) > 1 else sys.stdout
+    output.write('\n'.join(script.source))
+    print('{} subroutines, {} bytes of bytecode'.format(len(script.subroutines), len(script.bytecode)), file=sys.stderr)
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+"""Headless kinematic simulator for evaluating gaits faster than real time.
+
+The gait code runs unchanged against a SimulatedSerial on a simulated
+clock. Every sleep is cut into SAMPLE-second steps, and after each step the
+servo outputs (which move at their Maestro speeds) are sampled. Forward
+kinematics with the leg geometry in epoche.py turns the samples into foot
+positions in body coordinates, and from those:
+
+- contact: feet within CONTACT mm of the lowest one are on the ground
+- displacement: the body moves by the planar rigid motion that best keeps
+  the feet in contact where they were in the previous sample
+- slip: how far the contact feet stray from that motion, i.e. would have
+  to slide over the ground, in mm
+- stability margin: distance from the body centre (taken as the centre
+  of mass) to the nearest edge of the contact feet's support polygon;
+  negative when the centre is outside it or fewer than three feet are down
+
+Results are reported per gait cycle. evaluate() is the entry point for
+scripts; with matplotlib installed the command line can also plot the
+body path and margin.
+
+Usage: gaitsim.py [MODE] [CYCLES] [name=value ...] [--plot FILE]
+    MODE is a walking command (forward, back, left, right); name=value
+    sets a gait parameter such as delay=0.08 or height=70, or the swing
+    profile=stepped, cycloid or bezier.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+os.environ.setdefault('EPOCHE_TTY', 'sim')
+import epoche
+import maestro
+import trajectory
+
+SAMPLE = 0.01
+CONTACT = 3.0
+# top speed of the servos in degrees per second (0.15 s per 60 degrees)
+SERVO_SPEED = 400
+# swing profiles: the stepped phases, or smooth gaits on a trajectory shape
+PROFILES = ('stepped',) + tuple(trajectory.SHAPES)
+
+class SampledClock(maestro.SimulatedClock):
+    """Simulated clock that samples the servo outputs every `step` seconds while sleeping."""
+
+    def __init__(self, step=SAMPLE):
+        maestro.SimulatedClock.__init__(self)
+        self.step = step
+        self.usb = None
+        self.samples = []  # (time, servo outputs)
+
+    def sleep(self, seconds):
+        while seconds > 1e-9:
+            step = min(self.step, seconds)
+            self.now += step
+            seconds -= step
+            self.usb.update()
+            self.samples.append((self.now, list(self.usb.Positions)))
+
+def feet(positions):
+    """Foot positions (..., 6, 3) in body coordinates for Maestro outputs (..., channels)."""
+    angles = (positions[..., epoche.PINS] - epoche.HOMES)/epoche.STEPS
+    direction = np.radians(epoche.HEADINGS + epoche.SIDES*angles[..., epoche.coxa])
+    a = np.radians(angles[..., epoche.tibia])
+    b = np.radians(angles[..., epoche.tibia] + angles[..., epoche.patella])
+    reach = epoche.COXA_LENGTH + epoche.TIBIA_LENGTH*np.cos(a) + epoche.PATELLA_LENGTH*np.cos(b)
+    x = epoche.MOUNTS[:, 0] + reach*np.cos(direction)
+    y = epoche.MOUNTS[:, 1] + reach*np.sin(direction)
+    z = epoche.TIBIA_LENGTH*np.sin(a) + epoche.PATELLA_LENGTH*np.sin(b)
+    return np.stack([x, y, z], axis=-1)
+
+def rigid(p, q, weights):
+    """Planar rigid motions best taking points q onto p, row by row.
+
+    p and q are (n, m, 2) and weights (n, m) says which points count. Returns
+    the rotation angles (n), translations (n, 2) and each point's distance
+    from where the motion puts it (n, m).
+    """
+    w = weights/np.maximum(weights.sum(axis=1, keepdims=True), 1)
+    pc = np.einsum('ni,nia->na', w, p)
+    qc = np.einsum('ni,nia->na', w, q)
+    h = np.einsum('ni,nia,nib->nab', w, q - qc[:, None], p - pc[:, None])
+    angle = np.arctan2(h[:, 0, 1] - h[:, 1, 0], h[:, 0, 0] + h[:, 1, 1])
+    c, s = np.cos(angle)[:, None], np.sin(angle)[:, None]
+    moved = np.stack([c*q[..., 0] - s*q[..., 1], s*q[..., 0] + c*q[..., 1]], axis=-1)
+    shift = pc - np.stack([c[:, 0]*qc[:, 0] - s[:, 0]*qc[:, 1], s[:, 0]*qc[:, 0] + c[:, 0]*qc[:, 1]], axis=-1)
+    return angle, shift, np.linalg.norm(p - moved - shift[:, None], axis=-1)
+
+def margins(points, contact, chunk=4096):
+    """Signed distance from the origin to the edge of the support polygon, row by row.
+
+    points is (n, m, 2) and contact (n, m) marks the feet that support the
+    body. An edge from foot i to foot j bounds the polygon when no other
+    contact foot lies to its right; the margin is the least distance of the
+    origin to the left of such an edge, so it is negative outside the
+    polygon. Two contact feet give minus the distance to the line through
+    them; fewer give -inf.
+    """
+    result = np.empty(len(points))
+    m = points.shape[1]
+    others = ~np.eye(m, dtype=bool)
+    for first in range(0, len(points), chunk):
+        p, on = points[first:first+chunk], contact[first:first+chunk]
+        a = p[:, :, None, :]
+        d = p[:, None, :, :] - a  # edge i -> j
+        k = p[:, None, None, :, :] - a[:, :, :, None, :]
+        side = d[..., None, 0]*k[..., 1] - d[..., None, 1]*k[..., 0]
+        bounding = np.all((side >= -1e-6) | ~on[:, None, None, :], axis=-1)
+        edges = bounding & on[:, :, None] & on[:, None, :] & others
+        length = np.maximum(np.hypot(d[..., 0], d[..., 1]), 1e-9)
+        distance = (d[..., 1]*a[..., 0] - d[..., 0]*a[..., 1])/length
+        best = np.where(edges, distance, np.inf).min(axis=(1, 2))
+        best[on.sum(axis=1) < 2] = -np.inf
+        result[first:first+chunk] = best
+    return result
+
+def analyse(times, positions, cycles):
+    """Per-cycle displacement, slip and stability margin from sampled servo outputs.
+
+    cycles gives the sample index each cycle starts at; a cycle is measured
+    from the sample before it, so the first should start at 1 or later.
+    Returns the results with the body track (x, y, heading in radians) and
+    stability margin at every sample.
+    """
+    paths = feet(np.asarray(positions, dtype=float))
+    contact = paths[..., 2] < paths[..., 2].min(axis=1, keepdims=True) + CONTACT
+    stability = margins(paths[..., :2], contact)
+    # motion from each sample to the next, in the body frame of the earlier one
+    both = contact[1:] & contact[:-1]
+    angle, shift, residual = rigid(paths[:-1, :, :2], paths[1:, :, :2], both)
+    held = both.sum(axis=1) >= 2
+    angle, shift = np.where(held, angle, 0), np.where(held[:, None], shift, 0)
+    slip = np.concatenate([[0], np.where(held, (residual*both).sum(axis=1), 0)])
+    heading = np.concatenate([[0], np.cumsum(angle)])
+    c, s = np.cos(heading[:-1]), np.sin(heading[:-1])
+    step = np.stack([c*shift[:, 0] - s*shift[:, 1], s*shift[:, 0] + c*shift[:, 1]], axis=-1)
+    track = np.column_stack([np.concatenate([[(0, 0)], np.cumsum(step, axis=0)]), heading])
+    results = []
+    bounds = list(cycles) + [len(times)]
+    for start, end in zip(bounds, bounds[1:]):
+        start = max(start, 1)
+        if end <= start:
+            continue
+        before = track[start-1]
+        moved = track[end-1] - before
+        # express the displacement in the body frame at the start of the cycle
+        c, s = np.cos(-before[2]), np.sin(-before[2])
+        results.append({
+            'seconds': times[end-1] - times[start-1],
+            'right': float(c*moved[0] - s*moved[1]),
+            'forward': float(s*moved[0] + c*moved[1]),
+            'turn': float(np.degrees(moved[2])),
+            'slip': float(slip[start:end].sum()),
+            'margin': float(stability[start:end].min()),
+        })
+    return results, track, stability
+
+def evaluate(mode='forward', cycles=4, profile=None, **parameters):
+    """Walk `cycles` cycles of a walking mode on the simulator; return (per-cycle results, track, stability, times).
+
+    profile picks the swing profile from PROFILES, overriding EPOCHE_SMOOTH;
+    other keywords set epoche gait parameters for the run.
+    """
+    gait, d = epoche.GAITS[mode]
+    if profile is not None:
+        turning = gait in (epoche.turn, epoche.swivel)
+        if profile == 'stepped':
+            gait = epoche.turn if turning else epoche.dowalk
+        else:
+            gait = epoche.swivel if turning else epoche.glide
+            parameters['TRAJECTORY_SHAPE'] = profile
+    saved = {name: getattr(epoche, name) for name in parameters}
+    control = epoche.control
+    saved_state = control.usb, control.clock, control.sleep, control.Targets, control.Speeds
+    clock = SampledClock()
+    # Maestro speed units are quarter-microseconds per 10 ms
+    usb = maestro.SimulatedSerial(clock=clock, limit=SERVO_SPEED*abs(epoche.STEPS[0])/100)
+    clock.usb = usb
+    control.usb, control.clock, control.sleep = usb, clock, clock.sleep
+    control.Targets = [0] * len(control.Targets)
+    control.Speeds = [0] * len(control.Speeds)
+    try:
+        for name, value in parameters.items():
+            setattr(epoche, name, value)
+        epoche.stand()
+        usb.update()
+        clock.samples = [(clock.now, list(usb.Positions))]
+        starts = []
+        for cycle in range(cycles):
+            starts.append(len(clock.samples))
+            epoche.play(gait, d)
+    finally:
+        control.usb, control.clock, control.sleep, control.Targets, control.Speeds = saved_state
+        for name, value in saved.items():
+            setattr(epoche, name, value)
+    times = [t for t, _ in clock.samples]
+    results, track, stability = analyse(times, [p for _, p in clock.samples], starts)
+    return results, track, stability, times
+
+def plot(track, stability, times, path):
+    """Save the body path and stability margin to an image (needs matplotlib)."""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+    figure, (top, bottom) = pyplot.subplots(2, 1, figsize=(6, 8))
+    top.plot(track[:, 0], track[:, 1])
+    top.set_aspect('equal')
+    top.set_xlabel('right (mm)')
+    top.set_ylabel('forward (mm)')
+    bottom.plot(times, stability)
+    bottom.set_xlabel('time (s)')
+    bottom.set_ylabel('stability margin (mm)')
+    figure.savefig(path)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    output = None
+    if '--plot' in args:
+        i = args.index('--plot')
+        output = args[i+1]
+        del args[i:i+2]
+    parameters = dict(arg.split('=') for arg in args if '=' in arg)
+    for name, value in parameters.items():
+        if name != 'profile':
+            parameters[name] = float(value)
+    args = [arg for arg in args if '=' not in arg]
+    mode = args[0] if args else 'forward'
+    cycles = int(args[1]) if len(args) > 1 else 4
+    start = time.perf_counter()
+    results, track, stability, times = evaluate(mode, cycles, **parameters)
+    elapsed = time.perf_counter() - start
+    print('cycle  seconds  forward   right    turn    slip  margin')
+    for n, r in enumerate(results):
+        print('{:5} {:8.3f} {:8.1f} {:7.1f} {:7.1f} {:7.1f} {:7.1f}'.format(
+            n, r['seconds'], r['forward'], r['right'], r['turn'], r['slip'], r['margin']))
+    print('{:.1f}s simulated in {:.2f}s ({:.0f}x real time)'.format(times[-1], elapsed, times[-1]/elapsed))
+    if output:
+        plot(track, stability, times, output)
@@ -1,5 +1,6 @@
 #!python3
 
+import cpg
 import maestro
 import transformations as tf
 import numpy as np
@@ -257,12 +258,13 @@ if walk:
         time.sleep(0.001)
 
 if dance:
-    angle = 0
+    # all 18 servos swing together, computed and sent as one frame per tick
+    bank = cpg.Oscillators(18, frequency=0.5, amplitude=.5)
+    tick = 0.02
     while True:
-        angle += 0.01
-        for servo in range(18):
-            pod.setTarget(servo, angle_to_steps(.5*sin(angle)))
-            time.sleep(0.0001)
+        steps = ((1500 + bank.step(tick)*700/(pi/2))*4).astype(int)
+        pod.setTargets(dict(enumerate(steps.tolist())))
+        time.sleep(tick)
 
 def something(line):
   print('read input:', line, end='')
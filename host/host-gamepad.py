@@ -9,7 +9,26 @@ import time
 #import pickle
 #import numpy as np
 import pygame
+import struct
 import zmq
+from inputs import InputSampler
+from latency import Histogram, tag
+from link import RobotLink
+from timing import SCHEDULE_LEAD, ClockEstimate, schedule
+
+
+# body-pose setpoints for the robot's 'body' mode: x, y, z (mm), pitch, roll, yaw (degrees)
+POSE_PORT = 15790
+POSE = struct.Struct('<6f')
+# full stick deflection
+MAX_SHIFT = 25.0
+MAX_TILT = 12.0
+# the right stick click plays this maneuver on the robot, which reports its
+# progress to PROGRESS_PORT; moving the right stick takes over again
+MACRO = 'macro forward 5; right 2; stand'
+PROGRESS_PORT = 15792
+# commands that set the robot's mode, which are safe to send twice
+STATES = ('paused', 'forward', 'back', 'left', 'right', 'body')
 
 
 class CommProcess(multiprocessing.Process):
@@ -23,24 +42,64 @@ class CommProcess(multiprocessing.Process):
     def run(self):
         port = 15787
         context = zmq.Context()
-        robot = context.socket(zmq.REQ)
-        robot.connect('tcp://192.168.7.2:{}'.format(port))
+        robot = RobotLink(context, 'tcp://192.168.7.2:{}'.format(port))
+
+        # commands arrive as (command, time input was sampled) and go out with a trace ID
+        histograms = {'input->send': Histogram()}
+        trace_id = 0
+        # once the robot's clock is known, commands run a fixed lead after their input
+        clock = ClockEstimate()
+        # the newest mode sent: when a request goes unanswered this goes out
+        # again, unless a newer mode is already waiting
+        state = None
+        lost = False
+        resent = 0
 
         while not self.done:
-            command_flag = False
+            commands = []
             try:
+                commands.append(self.command_queue.get(timeout=0 if lost else 0.1))
                 while True:
-                    command = self.command_queue.get(block=False)
-                    command_flag = True
+                    commands.append(self.command_queue.get(block=False))
             except queue.Empty:
                 pass
-            if command_flag:
-                robot.send_string(command)
+            # of the modes waiting only the newest matters; one-shot commands
+            # like 'stats' or a macro all go out, in order
+            modes = [i for i, (command, sampled) in enumerate(commands) if command in STATES]
+            commands = [item for i, item in enumerate(commands) if item[0] not in STATES or i == modes[-1]]
+            for command, sampled in commands:
+                histograms['input->send'].record(time.monotonic() - sampled)
+            if lost and state is not None and not modes:
+                commands.insert(0, state)
+                resent += 1
+            lost = False
+            if not commands:
+                if clock.due():
+                    clock.sync(robot)
+                continue
+            for command, sampled in commands:
+                if command in STATES:
+                    state = (command, sampled)
+                trace_id += 1
+                message = command
+                if clock.samples and command not in ('stats', 'q'):
+                    message = schedule(command, clock.robot(sampled) + SCHEDULE_LEAD)
                 #print("Sent to robot: {}".format(command))
-                response = robot.recv_string()
-                if response != '':
-                    #print("Received from robot: {}".format(response))
-                    pass
+                response = robot.request(tag(message, trace_id))
+                if response is None:
+                    print('No reply to {}, reconnected.'.format(command))
+                    lost = True
+                    continue
+                if response.startswith('error'):
+                    print('Robot refused {}: {}'.format(command, response))
+                if command == 'stats':
+                    print('Robot latency:\n{}'.format(response))
+                    print('Host latency:')
+                    for name, histogram in histograms.items():
+                        print('{:>16}: {}'.format(name, histogram.summary()))
+                    print('{:>16}: {}'.format('send->reply', robot.rtt.summary()))
+                    print('{:>16}: {} resent, {}'.format('link', resent, robot.summary()))
+                    print('{:>16}: {}'.format('robot clock', clock.summary()))
 
 def run():
 
@@ -55,26 +114,41 @@ def run():
     
     pygame.init()
     screen = pygame.display.set_mode((1024,768))
-    pygame.joystick.init()
+    screen.fill((255, 255, 255))
+    pygame.display.flip()
+    sampler = InputSampler()
 
     command_queue = multiprocessing.Queue()
     robot = CommProcess(command_queue)
     robot.start()
 
+    # setpoints go straight out at the sampling rate; the robot keeps the latest
+    poses = zmq.Context().socket(zmq.PUB)
+    poses.setsockopt(zmq.SNDHWM, 1)
+    poses.connect('tcp://192.168.7.2:{}'.format(POSE_PORT))
+    body_mode = False
+    last_pose = None
+    progress = zmq.Context().socket(zmq.SUB)
+    progress.setsockopt(zmq.SUBSCRIBE, b'')
+    progress.connect('tcp://192.168.7.2:{}'.format(PROGRESS_PORT))
+    macro_running = False
+
     timer = time.time()
 
     mode = 'paused'
 
     done = False
     while not done:
-        joy = pygame.joystick.Joystick(0)
-        joy.init()
         flag = False
-        for event in pygame.event.get():
+        events = sampler.poll()
+        sampled = time.monotonic()
+        for event in events:
             if event.type == pygame.KEYDOWN:
                 if event.unicode == 'q':
                     done = True
                     break
+                if event.unicode == 'd': # dump latency histograms
+                    command_queue.put(('stats', sampled))
             if event.type == pygame.QUIT:
                 done = True
                 break
@@ -85,7 +159,7 @@ def run():
                     stopped = True
                     flag = True
                 if button == 4 or button == 5:
-                    if joy.get_button(4) == joy.get_button(5) == 1:
+                    if sampler.button(4) == sampler.button(5) == 1:
                         print('Fast mode enabled.')
                         fast_mode = True
                         flag = True
@@ -101,10 +175,17 @@ def run():
                     print('Song {} selected.'.format(button))
                     song = button
                     flag = True
+                if button == 10: # left stick click: body pose mode on/off
+                    body_mode = not body_mode
+                    print('Body mode {}.'.format('on' if body_mode else 'off'))
+                if button == 11: # right stick click: run MACRO
+                    print('Macro: {}'.format(MACRO))
+                    command_queue.put((MACRO, sampled))
+                    macro_running = True
             if event.type == pygame.JOYBUTTONUP:
                 button = event.button
                 if button == 6 or button == 7:
-                    if joy.get_button(6) == joy.get_button(7) == 0:
+                    if sampler.button(6) == sampler.button(7) == 0:
                         print('Unstopped.')
                         stopped = False
                         flag = True
@@ -113,16 +194,16 @@ def run():
                     fast_mode = False
                     flag = True
                 if 0 <= button <= 3:
-                    if joy.get_button(0) == joy.get_button(1) == joy.get_button(2) == joy.get_button(3) == 0:
+                    if sampler.button(0) == sampler.button(1) == sampler.button(2) == sampler.button(3) == 0:
                         song = -1
                         flag = True
         #old_left = left_speed
         #old_right = right_speed
-        #left_speed = -joy.get_axis(1)
-        right_speed = joy.get_axis(3)
+        #left_speed = -sampler.axis(1)
+        right_speed = sampler.axis(3)
 
-        perp = joy.get_axis(2)
-        parallel = joy.get_axis(3)
+        perp = sampler.axis(2)
+        parallel = sampler.axis(3)
 
         mode = 'paused'
         if perp > 0.5:
@@ -134,8 +215,15 @@ def run():
         if parallel < -0.5:
             mode = 'forward'
 
+        if body_mode:
+            # left stick shifts the body, right stick tilts it
+            mode = 'body'
+            setpoint = (MAX_SHIFT*sampler.axis(0), -MAX_SHIFT*sampler.axis(1), 0.0,
+                        -MAX_TILT*sampler.axis(3), MAX_TILT*sampler.axis(2), 0.0)
+            if setpoint != last_pose:
+                poses.send(POSE.pack(*setpoint), zmq.NOBLOCK)
+                last_pose = setpoint
 
-        print(mode)
         """
         if fast_mode:
             left_speed *= max_speed_fast
@@ -149,13 +237,18 @@ def run():
 
         #if flag or old_left != left_speed or old_right != right_speed or time.time()-timer > 0.05:
             #command_queue.put('{} {} {} {} {}'.format({True:1,False:0}[stopped], {True:1,False:0}[automatic_mode], left_speed, right_speed, song))
-        command_queue.put(mode)
+        while progress.poll(0):
+            report = progress.recv_string()
+            print(report)
+            if report.endswith(('done', 'aborted')):
+                macro_running = False
+
+        # an idle heartbeat would cut a running macro short
+        if not (macro_running and mode == 'paused') and sampler.changed(mode):
+            print(mode)
+            command_queue.put((mode, sampled))
             #timer = 0
 
-        time.sleep(0.1)
-        screen.fill((255, 255, 255))
-        pygame.display.flip()
-
     #time.sleep(1) # allow time for threads to finish
 
 if __name__ == "__main__":
@@ -10,6 +10,8 @@ import pickle
 import numpy as np
 import pygame
 import zmq
+from inputs import InputSampler
+from link import RobotLink
 
 class CommProcess(multiprocessing.Process):
     """Communicates with robot."""
@@ -23,8 +25,9 @@ class CommProcess(multiprocessing.Process):
     def run(self):
         port = 15787
         context = zmq.Context()
-        robot = context.socket(zmq.REQ)
-        robot.connect('tcp://zeitgeist.local:{}'.format(port))
+        robot = RobotLink(context, 'tcp://zeitgeist.local:{}'.format(port))
+        # wheel speeds whose reply was lost; they are safe to send again
+        lost = None
 
         while not self.done:
             command_flag = False
@@ -34,17 +37,24 @@ class CommProcess(multiprocessing.Process):
                     command_flag = True
             except queue.Empty:
                 pass
+            if not command_flag and lost is not None:
+                command = lost
+                command_flag = True
             if command_flag:
                 if not len(command) == 2:
                     self.done = True
                     break
-                robot.send_string('c {} {}'.format(command[0], command[1]))
+                response = robot.request('c {} {}'.format(command[0], command[1]))
                 print("Sent to robot: {}".format(command))
-                response = robot.recv_string()
+                if response is None:
+                    print('No reply to {}, reconnected.'.format(command))
+                    lost = command
+                    continue
+                lost = None
                 print("Received from robot: {}".format(response))
 
-        robot.send_string('q')
-        robot.recv_string()
+        while robot.request('q') is None:
+            pass
 
 def run():
 
@@ -62,17 +72,19 @@ def run():
     
     pygame.init()
     screen = pygame.display.set_mode((2*size, 2*size))
+    sampler = InputSampler()
 
     image_queue = multiprocessing.Queue()
     command_queue = multiprocessing.Queue()
     robot = CommProcess(image_queue, command_queue)
     robot.start()
 
+    redraw = True
     done = False
     while not done:
         old_left = left
         old_right = right
-        for event in pygame.event.get():
+        for event in sampler.poll():
             if event.type == pygame.QUIT:
                 done = True
                 command_queue.put('q')
@@ -93,8 +105,12 @@ def run():
                     enabled = not enabled
                     left = 0
                     right = 0
+                    redraw = True
+        if done:
+            break
         if(old_left != left or old_right != right):
             print('GUI sensed movement: ({},{}):\t{}\t{}'.format(x, y, left, right))
+        if sampler.changed((left, right)):
             command_queue.put((left, right))
         """
         try:
@@ -103,6 +119,9 @@ def run():
         except queue.Empty:
             pass
         """
+        if not redraw:
+            continue
+        redraw = False
         if enabled :
             screen.fill((0, 0, 0))
             pygame.draw.circle(screen, (255, 255, 0), (size, size), deadzone)
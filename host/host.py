@@ -4,12 +4,37 @@ Master program """
 
 import multiprocessing
 import math
+import os
 import queue
+import struct
+import sys
+import threading
 import time
+import zlib
 import pickle
 import numpy as np
+import cv2
 import pygame
 import zmq
+from inputs import InputSampler
+from link import RobotLink
+
+# the frame queue helper is the robot's own
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import latest
+
+# frame id, timestamp, height, width, jpeg length (matches robot.encode_frame)
+FRAME_HEADER = struct.Struct('<IdHHI')
+
+def decode_frame(frame):
+    """Unpack a robot video frame into (frame id, timestamp, BGR image, raw depth)."""
+    frame_id, stamp, height, width, size = FRAME_HEADER.unpack_from(frame)
+    start = FRAME_HEADER.size
+    jpeg = np.frombuffer(frame, dtype=np.uint8, count=size, offset=start)
+    image = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+    delta = np.frombuffer(zlib.decompress(frame[start+size:]), dtype=np.int16)
+    depth = np.cumsum(delta.reshape(height, width), axis=1, dtype=np.int16).astype(np.uint16)
+    return frame_id, stamp, image, depth
 
 class CommProcess(multiprocessing.Process):
     """Communicates with robot."""
@@ -20,11 +45,27 @@ class CommProcess(multiprocessing.Process):
         self.image_queue = image_queue
         self.command_queue = command_queue
 
+    def receive_video(self, context):
+        """Decode frames from the robot's video stream into the image queue."""
+        port = 15788
+        video = context.socket(zmq.SUB)
+        video.setsockopt(zmq.RCVHWM, 2)
+        video.setsockopt(zmq.SUBSCRIBE, b'')
+        video.connect('tcp://zeitgeist.local:{}'.format(port))
+        while not self.done:
+            if not video.poll(1000):
+                continue
+            # keep only the newest frame if the GUI falls behind
+            latest.put(self.image_queue, decode_frame(video.recv()))
+
     def run(self):
         port = 15787
         context = zmq.Context()
-        robot = context.socket(zmq.REQ)
-        robot.connect('tcp://zeitgeist.local:{}'.format(port))
+        robot = RobotLink(context, 'tcp://zeitgeist.local:{}'.format(port))
+        # video has its own socket and thread so it never delays commands
+        threading.Thread(target=self.receive_video, args=(context,), daemon=True).start()
+        # wheel speeds whose reply was lost; they are safe to send again
+        lost = None
 
         while not self.done:
             command_flag = False
@@ -34,17 +75,24 @@ class CommProcess(multiprocessing.Process):
                     command_flag = True
             except queue.Empty:
                 pass
+            if not command_flag and lost is not None:
+                command = lost
+                command_flag = True
             if command_flag:
                 if not len(command) == 2:
                     self.done = True
                     break
-                robot.send_string('c {} {}'.format(command[0], command[1]))
+                response = robot.request('c {} {}'.format(command[0], command[1]))
                 print("Sent to robot: {}".format(command))
-                response = robot.recv_string()
+                if response is None:
+                    print('No reply to {}, reconnected.'.format(command))
+                    lost = command
+                    continue
+                lost = None
                 print("Received from robot: {}".format(response))
 
-        robot.send_string('q')
-        robot.recv_string()
+        while robot.request('q') is None:
+            pass
 
 def run():
 
@@ -62,17 +110,20 @@ def run():
     
     pygame.init()
     screen = pygame.display.set_mode((2*size, 2*size))
+    sampler = InputSampler()
 
-    image_queue = multiprocessing.Queue()
+    image_queue = multiprocessing.Queue(maxsize=1)
     command_queue = multiprocessing.Queue()
     robot = CommProcess(image_queue, command_queue)
     robot.start()
 
+    frame = None
+    redraw = True
     done = False
     while not done:
         old_left = left
         old_right = right
-        for event in pygame.event.get():
+        for event in sampler.poll():
             if event.type == pygame.QUIT:
                 done = True
                 command_queue.put('q')
@@ -93,18 +144,27 @@ def run():
                     enabled = not enabled
                     left = 0
                     right = 0
+                    redraw = True
+        if done:
+            break
         if(old_left != left or old_right != right):
             print('GUI sensed movement: ({},{}):\t{}\t{}'.format(x, y, left, right))
+        if sampler.changed((left, right)):
             command_queue.put((left, right))
-        """
         try:
-            image = image_queue.get(block=False)
-            print(image.shape)
+            frame_id, stamp, image, depth = image_queue.get(block=False)
+            image = cv2.resize(image, (2*size, 2*size))
+            frame = pygame.image.frombuffer(cv2.cvtColor(image, cv2.COLOR_BGR2RGB).tobytes(), (2*size, 2*size), 'RGB')
+            redraw = True
         except queue.Empty:
             pass
-        """
+        if not redraw:
+            continue
+        redraw = False
         if enabled :
             screen.fill((0, 0, 0))
+            if frame is not None:
+                screen.blit(frame, (0, 0))
             pygame.draw.circle(screen, (255, 255, 0), (size, size), deadzone)
         else:
             screen.fill((255, 255, 255))
@@ -0,0 +1,65 @@
+"""Event-driven input sampling shared by the host GUIs."""
+
+import time
+import pygame
+
+class InputSampler:
+    """Wait for pygame input and decide when state is worth sending.
+
+    Instead of spinning, poll() blocks on pygame.event.wait for up to
+    `timeout` seconds and then drains everything already queued, so a burst
+    of events is handled in one pass. The joystick handle is opened once and
+    reused, axes get a `deadband`, and changed() lets a state through only
+    when it differs from the last one sent or when `heartbeat` seconds have
+    passed (so the robot can tell a quiet host from a dead one).
+    """
+
+    def __init__(self, timeout=0.05, deadband=0.1, heartbeat=0.5):
+        self.timeout = timeout
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        self.joystick = None
+        self.sent = None
+        self.sent_time = 0
+        self.open_joystick()
+
+    def open_joystick(self):
+        pygame.joystick.init()
+        if self.joystick is None and pygame.joystick.get_count() > 0:
+            self.joystick = pygame.joystick.Joystick(0)
+            self.joystick.init()
+
+    def poll(self):
+        """Wait for input and return every pending event."""
+        event = pygame.event.wait(int(self.timeout*1000))
+        events = [] if event.type == pygame.NOEVENT else [event]
+        events.extend(pygame.event.get())
+        for event in events:
+            if event.type == pygame.JOYDEVICEADDED:
+                self.open_joystick()
+            if event.type == pygame.JOYDEVICEREMOVED:
+                self.joystick = None
+        return events
+
+    def axis(self, axis):
+        """Joystick axis value, zero inside the deadband or without a joystick."""
+        if self.joystick is None:
+            return 0
+        value = self.joystick.get_axis(axis)
+        if abs(value) < self.deadband:
+            return 0
+        return value
+
+    def button(self, button):
+        if self.joystick is None:
+            return 0
+        return self.joystick.get_button(button)
+
+    def changed(self, state):
+        """True (and remember `state` as sent) if it is new or a heartbeat is due."""
+        now = time.monotonic()
+        if state == self.sent and now - self.sent_time < self.heartbeat:
+            return False
+        self.sent = state
+        self.sent_time = now
+        return True
@@ -0,0 +1,7 @@
+"""Host-side latency histograms and command trace tags: the robot's own, from metrics.py."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metrics import Histogram, tag
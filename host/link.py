@@ -0,0 +1,71 @@
+"""Request/reply link to the robot's command port that survives lost messages.
+
+A plain REQ socket waits forever for a reply, so one message lost over
+Wi-Fi wedges it. RobotLink is ZeroMQ's "lazy pirate" client instead: it
+polls for each reply with a deadline and, when the deadline passes,
+closes the socket and opens a fresh one, ready to send again. What to send
+again is the caller's call; a request may have reached the robot even if
+its reply didn't, so only resend what is harmless to repeat.
+
+The deadline follows the measured round trips as TCP's retransmission
+timeout does (smoothed RTT plus four times its variation), within
+MIN_TIMEOUT and MAX_TIMEOUT, and doubles after each miss. A responsive
+robot is thus given up on after tens of milliseconds, while one busy
+finishing a walk cycle before it answers doesn't cause a reconnect on
+every request.
+"""
+
+import time
+import zmq
+from latency import Histogram
+
+MIN_TIMEOUT = 0.03
+MAX_TIMEOUT = 1.0
+
+class RobotLink:
+    """A REQ socket to the robot that is replaced whenever a reply is late."""
+
+    def __init__(self, context, address):
+        self.context = context
+        self.address = address
+        self.rtt = Histogram()
+        self.smoothed = None  # smoothed round trip and its mean deviation (seconds)
+        self.deviation = 0.0
+        self.timeout = MAX_TIMEOUT
+        self.timeouts = 0
+        self.socket = None
+        self.connect()
+
+    def connect(self):
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = self.context.socket(zmq.REQ)
+        # drop any unsent request with the old socket
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.address)
+
+    def request(self, message):
+        """Send a message and return the reply, or None if none came in time."""
+        sent = time.monotonic()
+        self.socket.send_string(message)
+        if self.socket.poll(self.timeout*1000):
+            reply = self.socket.recv_string()
+            self.measured(time.monotonic() - sent)
+            return reply
+        self.timeouts += 1
+        self.timeout = min(2*self.timeout, MAX_TIMEOUT)
+        self.connect()
+        return None
+
+    def measured(self, rtt):
+        self.rtt.record(rtt)
+        if self.smoothed is None:
+            self.smoothed = rtt
+            self.deviation = rtt/2
+        else:
+            self.deviation += (abs(rtt - self.smoothed) - self.deviation)/4
+            self.smoothed += (rtt - self.smoothed)/8
+        self.timeout = min(max(self.smoothed + 4*self.deviation, MIN_TIMEOUT), MAX_TIMEOUT)
+
+    def summary(self):
+        return '{} timeouts, timeout now {:.0f}ms'.format(self.timeouts, 1000*self.timeout)
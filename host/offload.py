@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""Plan gaits and solve IK on the host, streaming finished servo frames to the robot.
+
+This runs the robot's own gait code from epoche.py (its smooth gait tables,
+calculate_servo_angles and servo calibration) with no hardware attached,
+turns each tick into Maestro targets and publishes them to the robot's
+OFFLOAD_PORT as epoche.TARGET_FRAME messages. The robot only checks the
+targets against its servo limits and writes them out, so gaits too heavy
+for its CPU can run here. Put the robot in 'offload' mode first; each frame
+names the onboard gait it should walk if the stream stalls. Given a
+synchronized timing.ClockEstimate, frames are marked to run SCHEDULE_LEAD
+after their tick on the robot's clock, so they play out evenly however
+unevenly the network delivers them.
+
+Usage: offload.py [MODE] [SECONDS]
+    walks MODE (forward, back, left, right) for SECONDS, then stops
+"""
+
+import os
+import sys
+import time
+import zmq
+from link import RobotLink
+from timing import SCHEDULE_LEAD, ClockEstimate
+
+# the gait code lives with the robot's; drive a simulated Maestro here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('EPOCHE_TTY', 'sim')
+import epoche
+
+ROBOT = 'zeitgeist.local'
+
+class Offloader:
+    """Publishes {servo: angle} poses to the robot as target frames."""
+
+    def __init__(self, context, address=ROBOT, port=epoche.OFFLOAD_PORT, clock=None):
+        self.socket = context.socket(zmq.PUB)
+        # drop frames the network can't carry rather than queue stale ones
+        self.socket.setsockopt(zmq.CONFLATE, 1)
+        self.socket.connect('tcp://{}:{}'.format(address, port))
+        self.sequence = 0
+        self.tick = 0  # position in the gait cycle, kept between walk() calls
+        self.clock = clock
+
+    def send(self, angles, fallback=None, due=None):
+        """Send one pose for time `due` here (default now); fallback is the GAITS mode the robot walks if no more arrive."""
+        targets = [0] * len(epoche.servo_info)
+        for servo, angle in angles.items():
+            targets[servo] = epoche.target(servo, angle)
+        code = epoche.NO_FALLBACK if fallback is None else list(epoche.GAITS).index(fallback)
+        at = 0
+        if self.clock is not None and self.clock.samples:
+            at = self.clock.robot(time.monotonic() if due is None else due) + SCHEDULE_LEAD
+        self.socket.send(epoche.TARGET_FRAME.pack(self.sequence, at, code, *targets))
+        self.sequence = (self.sequence + 1) % (1 << 32)
+
+    def walk(self, mode, seconds):
+        """Stream a smooth walking gait for `seconds`, one frame per trajectory tick."""
+        gait, d = epoche.GAITS[mode]
+        turning = gait in (epoche.turn, epoche.swivel)
+        table = epoche.gait_table(epoche.forward, epoche.height, epoche.delay, d, turning,
+                                  epoche.TRAJECTORY_SHAPE)
+        start = due = time.monotonic()
+        while due - start < seconds:
+            self.send(table[self.tick % len(table)], mode, due)
+            self.tick += 1
+            # keep to the tick schedule however long the frame took
+            due += epoche.TRAJECTORY_TICK
+            time.sleep(max(0, due - time.monotonic()))
+
+    def body(self, *setpoint):
+        """Hold the feet and move the body as BodyStream would."""
+        self.send(epoche.calculate_servo_angles(*setpoint))
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'forward'
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    context = zmq.Context()
+    robot = RobotLink(context, 'tcp://{}:15787'.format(ROBOT))
+    clock = ClockEstimate()
+    while clock.due():
+        clock.sync(robot)
+    while robot.request('offload') is None:
+        pass
+    offloader = Offloader(context, clock=clock)
+    # the clock sync doubles as the command link's heartbeat
+    for beat in range(int(seconds*2)):
+        offloader.walk(mode, 0.5)
+        clock.sync(robot)
+    while robot.request('paused') is None:
+        pass
@@ -0,0 +1,66 @@
+"""Host-side clock synchronization with the robot and scheduled commands (see clocksync.py on the robot)."""
+
+import collections
+import time
+
+# round trips the offset is picked from
+SAMPLES = 8
+# resynchronize this often (seconds) to follow clock drift
+SYNC_INTERVAL = 1.0
+# run commands this long after the input was sampled: more than the usual network jitter
+SCHEDULE_LEAD = 0.05
+# round trips slower than this are dropped, leaving at most half of it as offset error
+MAX_ROUND_TRIP = 0.03
+
+def schedule(command, at):
+    """Append the robot-clock time a command should run at."""
+    return '{} @{:.4f}'.format(command, at)
+
+class ClockEstimate:
+    """Offset of the robot's time.monotonic from this one's, from 'sync' round trips.
+
+    A round trip sent at t0 and answered at t3 (host clock), which the robot
+    received at t1 and answered at t2 (robot clock), puts the offset at
+    ((t1 - t0) + (t2 - t3))/2, good to within half its network delay
+    (t3 - t0) - (t2 - t1). Of the last SAMPLES round trips the fastest
+    wins: it is the one least skewed by queuing on a busy link.
+
+    That bound assumes the robot stamps t1 as the request arrives. While
+    epoche.run() walks it only reads requests between gait cycles, so a
+    request can wait a whole cycle and be stamped with t1 close to t2; the
+    wait then counts as processing time rather than delay. Round trips
+    over MAX_ROUND_TRIP are therefore dropped whatever their delay.
+    """
+
+    def __init__(self, samples=SAMPLES):
+        self.samples = collections.deque(maxlen=samples)  # (delay, offset)
+        self.synced = 0  # host time of the last round trip
+
+    def sync(self, robot):
+        """One round trip over a link.RobotLink to the robot; False if the reply was lost or too slow to use."""
+        t0 = time.monotonic()
+        reply = robot.request('sync')
+        t3 = time.monotonic()
+        if reply is None or t3 - t0 > MAX_ROUND_TRIP:
+            return False
+        t1, t2 = (float(value) for value in reply.split())
+        self.add(t0, t1, t2, t3)
+        return True
+
+    def add(self, t0, t1, t2, t3):
+        self.samples.append(((t3 - t0) - (t2 - t1), ((t1 - t0) + (t2 - t3))/2))
+        self.synced = t3
+
+    def due(self):
+        """Whether it's time to resynchronize."""
+        return len(self.samples) < self.samples.maxlen or time.monotonic() - self.synced > SYNC_INTERVAL
+
+    def robot(self, host_time):
+        """The robot's clock reading at a time on this one."""
+        return host_time + min(self.samples)[1]
+
+    def summary(self):
+        if not self.samples:
+            return 'unsynchronized'
+        delay, offset = min(self.samples)
+        return 'offset={:.3f}s +/-{:.2f}ms'.format(offset, 1000*delay/2)
@@ -0,0 +1,79 @@
+"""Memoize inverse kinematics on quantized poses.
+
+Body poses repeat constantly (the neutral stance, a held lean, a joystick
+resting at the same deflection), so cached() wraps an IK function with an
+LRU cache keyed by its arguments rounded to a fixed resolution. The function
+is evaluated at the rounded pose, so a result depends only on its key and
+two setpoints within half a step of each other get the same answer. The
+cache is bounded by an estimate of the memory its entries take and evicts
+the least recently used ones beyond that. Hits and misses are counted on
+the cache and, when metrics are enabled, as '<name>.hit' and '<name>.miss'.
+"""
+
+import collections
+import functools
+import inspect
+import sys
+import metrics
+
+class QuantizedCache:
+    """LRU cache of function(*pose) for poses rounded to `resolution`, holding at most about max_bytes."""
+
+    def __init__(self, function, resolution=0.1, max_bytes=1 << 20, name='cache'):
+        self.function = function
+        parameters = inspect.signature(function).parameters.values()
+        self.names = {parameter.name: i for i, parameter in enumerate(parameters)}
+        self.defaults = [parameter.default for parameter in parameters]
+        self.resolution = resolution
+        self.max_bytes = max_bytes
+        self.name = name
+        self.entries = collections.OrderedDict()  # key -> (result, bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *args, **kwargs):
+        if kwargs or len(args) < len(self.defaults):
+            values = list(args) + self.defaults[len(args):]
+            for name, value in kwargs.items():
+                values[self.names[name]] = value
+            args = values
+        return tuple(round(value/self.resolution) for value in args)
+
+    def __call__(self, *args, **kwargs):
+        key = self.key(*args, **kwargs)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            metrics.count(self.name + '.hit')
+            return dict(entry[0])
+        self.misses += 1
+        metrics.count(self.name + '.miss')
+        result = self.function(*[step*self.resolution for step in key])
+        size = (sys.getsizeof(key) + sys.getsizeof(result)
+                + sum(sys.getsizeof(value) for value in result.values()))
+        self.entries[key] = (result, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+        metrics.gauge(self.name + '.bytes', self.bytes)
+        return dict(result)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def summary(self):
+        total = self.hits + self.misses
+        return 'n={} hit rate={:.1%} entries={} bytes={}'.format(
+            total, self.hits/total if total else 0, len(self.entries), self.bytes)
+
+def cached(resolution=0.1, max_bytes=1 << 20, name='cache'):
+    """Decorator wrapping a function of numeric arguments that returns a dict in a QuantizedCache."""
+    def decorate(function):
+        cache = QuantizedCache(function, resolution, max_bytes, name)
+        functools.update_wrapper(cache, function)
+        return cache
+    return decorate
@@ -0,0 +1,18 @@
+"""Bounded queues that keep the newest items, such as video frames.
+
+Shared by the robot's Kinect pipeline and the host's video receiver.
+"""
+
+import queue
+
+def put(frame_queue, item):
+    """Put on a bounded queue, discarding the oldest entry instead of blocking when full."""
+    while True:
+        try:
+            frame_queue.put(item, block=False)
+            return
+        except queue.Full:
+            try:
+                frame_queue.get(block=False)
+            except queue.Empty:
+                pass
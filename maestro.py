@@ -1,4 +1,8 @@
+import asyncio
+import queue
 import serial
+import threading
+import time
 from sys import version_info
 
 PY2 = version_info[0] == 2   #Running Python 2.x?
@@ -28,9 +32,13 @@ class Controller:
     # assumes.  If two or more controllers are connected to different serial
     # ports, or you are using a Windows OS, you can provide the tty port.  For
     # example, '/dev/ttyACM2' or for Windows, something like 'COM3'.
-    def __init__(self,ttyStr='/dev/ttyACM0',device=0x0c):
+    #
+    # Pass usb to use an already open port or a stand-in such as SimulatedSerial.
+    def __init__(self,ttyStr='/dev/ttyACM0',device=0x0c,usb=None):
         # Open the command port
-        self.usb = serial.Serial(ttyStr)
+        if usb is None:
+            usb = serial.Serial(ttyStr)
+        self.usb = usb
         # Command lead-in and device number are sent for each Pololu serial command.
         self.PololuCmd = chr(0xaa) + chr(device)
         # Track target position for each servo. The function isMoving() will
@@ -40,6 +48,16 @@ class Controller:
         # Servo minimum and maximum targets can be restricted to protect components.
         self.Mins = [0] * 24
         self.Maxs = [0] * 24
+        # Last speed sent to each channel (0 = unrestricted, the power-up default).
+        self.Speeds = [0] * 24
+        # Callables run with the raw bytes of every write, e.g. for tracing or logging.
+        self.writeHooks = []
+        # FramePipeline sending frames for this controller from its own thread, if any
+        self.pipeline = None
+        # Time source for wait_until_settled. Swap in a SimulatedClock (as clock
+        # and its sleep) to wait in simulated time.
+        self.clock = time.monotonic
+        self.sleep = time.sleep
         
     # Cleanup by closing USB serial port
     def close(self):
@@ -49,9 +67,20 @@ class Controller:
     def sendCmd(self, cmd):
         cmdStr = self.PololuCmd + cmd
         if PY2:
-            self.usb.write(cmdStr)
+            self.write(cmdStr)
         else:
-            self.usb.write(bytes(cmdStr,'latin-1'))
+            self.write(bytes(cmdStr,'latin-1'))
+
+    # Write already encoded bytes to the serial port, running any write hooks first.
+    # While a FramePipeline is attached, writes from any other thread wait for
+    # the frames it has queued, so two threads never interleave on the wire.
+    def write(self, data):
+        pipeline = self.pipeline
+        if pipeline is not None and threading.current_thread() is not pipeline.thread:
+            pipeline.flush()
+        for hook in self.writeHooks:
+            hook(data)
+        self.usb.write(data)
 
     # Set channels min and max value range.  Use this as a safety to protect
     # from accidentally moving outside known safe parameters. A setting of 0
@@ -94,6 +123,39 @@ class Controller:
         # Record Target value
         self.Targets[chan] = target
         
+    # Set several channels' targets, given as {channel: target}, in one write.
+    # Runs of consecutive channels are packed into "Set Multiple Targets"
+    # commands (Mini Maestro only), so a full frame is a few short commands.
+    def setTargets(self, targets):
+        buf = bytearray(7*len(targets))
+        end = self.encodeTargets(targets, buf)
+        if end:
+            self.write(buf[:end])
+
+    # Encode setTargets' commands into buf from offset, recording the targets as
+    # sent, and return the offset after them. buf needs 7 bytes per channel.
+    def encodeTargets(self, targets, buf, offset=0):
+        device = ord(self.PololuCmd[1])
+        chans = sorted(targets)
+        while chans:
+            run = 1
+            while run < len(chans) and chans[run] == chans[0] + run:
+                run += 1
+            buf[offset:offset+5] = bytes([0xaa, device, 0x1f, run, chans[0]])
+            offset += 5
+            for chan in chans[:run]:
+                target = targets[chan]
+                if self.Mins[chan] > 0 and target < self.Mins[chan]:
+                    target = self.Mins[chan]
+                if self.Maxs[chan] > 0 and target > self.Maxs[chan]:
+                    target = self.Maxs[chan]
+                buf[offset] = target & 0x7f
+                buf[offset+1] = (target >> 7) & 0x7f
+                offset += 2
+                self.Targets[chan] = target
+            chans = chans[run:]
+        return offset
+
     # Set speed of channel
     # Speed is measured as 0.25microseconds/10milliseconds
     # For the standard 1ms pulse width change to move a servo between extremes, a speed
@@ -104,6 +166,27 @@ class Controller:
         msb = (speed >> 7) & 0x7f #shift 7 and take next 7 bits for msb
         cmd = chr(0x07) + chr(chan) + chr(lsb) + chr(msb)
         self.sendCmd(cmd)
+        self.Speeds[chan] = speed
+
+    # Set several channels' speeds, given as {channel: speed}, in one write.
+    # Channels already at the requested speed are skipped.
+    def setSpeeds(self, speeds):
+        buf = bytearray(6*len(speeds))
+        end = self.encodeSpeeds(speeds, buf)
+        if end:
+            self.write(buf[:end])
+
+    # Encode setSpeeds' commands into buf from offset, recording the speeds as
+    # sent, and return the offset after them. buf needs 6 bytes per channel.
+    def encodeSpeeds(self, speeds, buf, offset=0):
+        device = ord(self.PololuCmd[1])
+        for chan, speed in sorted(speeds.items()):
+            if self.Speeds[chan] == speed:
+                continue
+            buf[offset:offset+6] = bytes([0xaa, device, 0x07, chan, speed & 0x7f, (speed >> 7) & 0x7f])
+            offset += 6
+            self.Speeds[chan] = speed
+        return offset
 
     # Set acceleration of channel
     # This provide soft starts and finishes when servo moves to target position.
@@ -129,6 +212,14 @@ class Controller:
         msb = ord(self.usb.read())
         return (msb << 8) + lsb
 
+    # Get the positions of several channels with a single write and read, returned
+    # as a list in the same order as chans.
+    def getPositions(self, chans):
+        cmd = ''.join(self.PololuCmd + chr(0x10) + chr(chan) for chan in chans)
+        self.write(cmd if PY2 else bytes(cmd,'latin-1'))
+        data = bytearray(self.usb.read(2*len(chans)))
+        return [data[2*i] + (data[2*i+1] << 8) for i in range(len(chans))]
+
     # Test to see if a servo has reached the set target position.  This only provides
     # useful results if the Speed parameter is set slower than the maximum speed of
     # the servo.  Servo range must be defined first using setRange. See setRange comment.
@@ -148,11 +239,33 @@ class Controller:
     def getMovingState(self):
         cmd = chr(0x13)
         self.sendCmd(cmd)
-        if self.usb.read() == chr(0):
+        # read() gives str on Python 2 and bytes on Python 3; ord() handles both
+        if ord(self.usb.read()) == 0:
             return False
         else:
             return True
 
+    # Wait until the given channels (or, with none given, all channels) have
+    # reached their targets, giving up after timeout seconds. Returns True if
+    # motion finished in time. Polls the moving state, then the positions of
+    # the channels in one bulk query, backing off from 2ms to 20ms between polls.
+    # Like getMovingState, this is only meaningful once Speed or Acceleration is set.
+    def wait_until_settled(self, chans=None, timeout=1.0):
+        deadline = self.clock() + timeout
+        interval = 0.002
+        while True:
+            if not self.getMovingState():
+                return True
+            if chans:
+                chans = [chan for chan in chans if self.Targets[chan] > 0]
+                if chans and self.getPositions(chans) == [self.Targets[chan] for chan in chans]:
+                    return True
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return False
+            self.sleep(min(interval, remaining))
+            interval = min(interval*2, 0.02)
+
     # Run a Maestro Script subroutine in the currently active script. Scripts can
     # have multiple subroutines, which get numbered sequentially from 0 on up. Code your
     # Maestro subroutine to either infinitely loop, or just end (return is not valid).
@@ -167,3 +280,369 @@ class Controller:
         cmd = chr(0x24)
         self.sendCmd(cmd)
 
+#
+#---------------------------
+# Asyncio front end
+#---------------------------
+#
+# Lets a Controller share an asyncio event loop with network handling. The
+# controller's port is swapped for a queue, so its usual methods (setTargets,
+# setSpeeds, write, ...) return at once, and a writer task sends the queued
+# bytes from a worker thread. Queries are coroutines here: each one waits for
+# the queue to drain and then reads the reply off the loop. Other attributes
+# pass through to the wrapped Controller, whose own query methods must not
+# be used while it is wrapped. start() the writer from inside the loop.
+# A Controller with a FramePipeline attached can't be wrapped: the pipeline
+# writes from its own thread, and the queue may only be fed from the loop's.
+#
+class AsyncController:
+    def __init__(self, control):
+        if control.pipeline is not None:
+            raise ValueError('a pipelined Controller cannot be driven from an event loop')
+        self.control = control
+        self.usb = control.usb
+        self.queue = asyncio.Queue()
+        self.task = None
+        control.usb = self
+
+    def __getattr__(self, name):
+        return getattr(self.control, name)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    # Writer task: send queued bytes in order, off the event loop
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await self.queue.get()
+            try:
+                await loop.run_in_executor(None, self.usb.write, data)
+            finally:
+                self.queue.task_done()
+
+    # Called by Controller.write (after its hooks) in place of the port's write
+    def write(self, data):
+        self.queue.put_nowait(data)
+
+    # Wait until everything queued so far has been written
+    async def drain(self):
+        await self.queue.join()
+
+    async def read(self, size=1):
+        await self.drain()
+        return await asyncio.get_running_loop().run_in_executor(None, self.usb.read, size)
+
+    async def getPositions(self, chans):
+        cmd = ''.join(self.control.PololuCmd + chr(0x10) + chr(chan) for chan in chans)
+        self.control.write(bytes(cmd,'latin-1'))
+        data = bytearray(await self.read(2*len(chans)))
+        return [data[2*i] + (data[2*i+1] << 8) for i in range(len(chans))]
+
+    async def getMovingState(self):
+        self.control.sendCmd(chr(0x13))
+        return ord(await self.read()) != 0
+
+    # As Controller.wait_until_settled, but other tasks run between polls
+    async def wait_until_settled(self, chans=None, timeout=1.0):
+        deadline = self.control.clock() + timeout
+        interval = 0.002
+        while True:
+            if not await self.getMovingState():
+                return True
+            if chans:
+                chans = [chan for chan in chans if self.control.Targets[chan] > 0]
+                if chans and await self.getPositions(chans) == [self.control.Targets[chan] for chan in chans]:
+                    return True
+            remaining = deadline - self.control.clock()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval*2, 0.02)
+
+    # Stop the writer and hand the port back to the Controller
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.control.usb = self.usb
+
+    def close(self):
+        self.stop()
+        self.usb.close()
+
+#
+#---------------------------
+# Double-buffered frames
+#---------------------------
+#
+# Overlaps computing the next frame with sending the current one. The
+# producer takes a preallocated buffer from acquire(), encodes a frame into
+# it (encodeSpeeds/encodeTargets) and hands it over with submit(length); a
+# transmit thread writes it through control.write while the producer fills
+# the other buffer. Buffers are passed by index and written as memoryviews,
+# so no frame is copied. acquire() blocks only when both buffers are still
+# waiting to go out, i.e. when the link is the bottleneck. Any other write to
+# the controller first waits for the queued frames (see Controller.write).
+# Not for a Controller wrapped in an AsyncController (see there).
+#
+class FramePipeline:
+    def __init__(self, control, size=None):
+        if isinstance(control.usb, AsyncController):
+            raise ValueError('an asyncio Controller cannot be pipelined')
+        self.control = control
+        # room for a speed and a target command on every channel
+        size = size or 13*len(control.Targets)
+        self.buffers = [bytearray(size), bytearray(size)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self.back = 0  # buffer the producer fills next
+        self.free = threading.Semaphore(2)
+        self.full = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.transmit, daemon=True)
+        self.thread.start()
+        control.pipeline = self
+
+    def transmit(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                return
+            index, length = item
+            try:
+                self.control.write(self.views[index][:length])
+            except Exception as e:
+                self.error = e
+            finally:
+                self.free.release()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # Wait for a free buffer and return it for the next frame
+    def acquire(self):
+        self.free.acquire()
+        self.check()
+        return self.buffers[self.back]
+
+    # Queue the first length bytes of the acquired buffer for sending
+    def submit(self, length):
+        if length:
+            self.full.put((self.back, length))
+            self.back ^= 1
+        else:
+            self.free.release()
+
+    # Encode and queue one frame of {channel: speed} and {channel: target}
+    def send(self, speeds, targets):
+        buf = self.acquire()
+        end = self.control.encodeSpeeds(speeds, buf)
+        self.submit(self.control.encodeTargets(targets, buf, end))
+
+    # Wait until every submitted frame has been written
+    def flush(self):
+        self.free.acquire()
+        self.free.acquire()
+        self.free.release()
+        self.free.release()
+        self.check()
+
+    def close(self):
+        self.flush()
+        self.full.put(None)
+        self.thread.join()
+        self.control.pipeline = None
+
+#
+# Number of bytes a Pololu command occupies, counting the 0xAA lead-in and
+# device number, or 0 if the buffered bytes cannot tell yet.
+#
+def commandLength(data):
+    if len(data) < 3:
+        return 0
+    cmd = data[2]
+    if cmd in (0x04, 0x07, 0x09, 0x28):
+        return 6
+    if cmd in (0x10, 0x27):
+        return 4
+    if cmd in (0x13, 0x21, 0x22, 0x24, 0x2e):
+        return 3
+    if cmd == 0x1f:
+        return 5 + 2*data[3] if len(data) > 3 else 0
+    raise ValueError('Unsupported Maestro command 0x{:02x}'.format(cmd))
+
+#
+#---------------------------
+# Simulated Maestro
+#---------------------------
+#
+# Stand-in for the serial port that interprets the Pololu protocol the way a
+# Maestro would, so the code above can run without hardware. Servo outputs
+# move toward their targets at the configured speed (acceleration is
+# ignored) as measured by clock, which defaults to real time; pass a
+# function returning simulated seconds to run faster or slower than that.
+# Script bytecode given to loadScript runs on the same clock when started
+# with runScriptSub (see gaitscript.py for the supported instructions).
+# Give a device number to ignore commands for other Maestros on the line,
+# and a limit (in speed units) to model servos that can't move any faster.
+#
+class SimulatedSerial:
+    def __init__(self, clock=time.monotonic, channels=24, device=None, limit=0):
+        self.clock = clock
+        self.device = device
+        self.limit = limit
+        self.Positions = [0] * channels
+        self.Targets = [0] * channels
+        self.Speeds = [0] * channels
+        self.Accels = [0] * channels
+        self.written = bytearray()  # everything ever written, for inspection
+        self.pending = bytearray()  # bytes of a command not yet complete
+        self.replies = bytearray()
+        self.updated = clock()
+        self.moved = ([], [])  # targets and speeds as of the last move
+        self.script = b''
+        self.subroutines = []
+        self.pc = None  # next script instruction, None when no script is running
+        self.stack = []
+        self.wake = 0  # clock time the running script continues at
+
+    # Install compiled script bytecode and its subroutine addresses
+    def loadScript(self, bytecode, subroutines):
+        self.script = bytes(bytecode)
+        self.subroutines = list(subroutines)
+        self.pc = None
+
+    def close(self):
+        pass
+
+    # Advance the script and servo outputs to the current clock time
+    def update(self):
+        now = self.clock()
+        while self.pc is not None and self.wake <= now:
+            self.move(self.wake)
+            self.step()
+        self.move(now)
+
+    # Run script instructions until the next delay or the end of the script
+    def step(self):
+        script = self.script
+        for _ in range(100000):
+            op = script[self.pc]
+            self.pc += 1
+            if op == 0:  # QUIT
+                self.pc = None
+                return
+            elif op == 32:  # LITERAL
+                self.stack.append(int.from_bytes(script[self.pc:self.pc+2], 'little', signed=True))
+                self.pc += 2
+            elif op == 33:  # LITERAL8
+                self.stack.append(script[self.pc])
+                self.pc += 1
+            elif op == 37:  # JUMP
+                self.pc = int.from_bytes(script[self.pc:self.pc+2], 'little')
+            elif op == 39:  # DELAY
+                self.wake += self.stack.pop()/1000
+                return
+            elif op in (73, 75, 76):  # SERVO, SPEED, ACCELERATION
+                chan = self.stack.pop()
+                value = self.stack.pop()
+                {73: self.Targets, 75: self.Speeds, 76: self.Accels}[op][chan] = value
+            else:
+                raise ValueError('Unsupported script opcode {}'.format(op))
+        raise RuntimeError('Script runs without delaying')
+
+    # Move servo outputs toward their targets up to clock time now
+    def move(self, now):
+        # every command updates first, so most calls repeat the last one's instant
+        if now == self.updated and self.Targets == self.moved[0] and self.Speeds == self.moved[1]:
+            return
+        # speed is in quarter-microseconds per 10ms
+        steps = (now - self.updated) * 100
+        self.updated = now
+        self.moved = (list(self.Targets), list(self.Speeds))
+        if self.Positions == self.Targets:
+            return
+        for chan, (position, target, speed) in enumerate(zip(self.Positions, self.Targets, self.Speeds)):
+            if position == target:
+                continue
+            if self.limit and position:
+                speed = min(speed, self.limit) if speed else self.limit
+            if speed == 0 or position == 0:
+                self.Positions[chan] = target
+            elif position < target:
+                self.Positions[chan] = min(target, position + speed*steps)
+            else:
+                self.Positions[chan] = max(target, position - speed*steps)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = bytes(data, 'latin-1')
+        self.written += data
+        self.pending += data
+        while True:
+            length = commandLength(self.pending)
+            if not length or len(self.pending) < length:
+                break
+            self.execute(bytes(self.pending[:length]))
+            del self.pending[:length]
+        return len(data)
+
+    def execute(self, cmd):
+        # on a shared line, only answer commands for this device number
+        if self.device is not None and cmd[1] != self.device:
+            return
+        self.update()
+        op = cmd[2]
+        if op == 0x04:
+            self.Targets[cmd[3]] = cmd[4] + (cmd[5] << 7)
+        elif op == 0x07:
+            self.Speeds[cmd[3]] = cmd[4] + (cmd[5] << 7)
+        elif op == 0x09:
+            self.Accels[cmd[3]] = cmd[4] + (cmd[5] << 7)
+        elif op == 0x1f:
+            for i in range(cmd[3]):
+                self.Targets[cmd[4]+i] = cmd[5+2*i] + (cmd[6+2*i] << 7)
+        elif op == 0x10:
+            position = int(self.Positions[cmd[3]])
+            self.replies += bytes([position & 0xff, position >> 8])
+        elif op == 0x13:
+            moving = any(p != t for p, t in zip(self.Positions, self.Targets))
+            self.replies.append(1 if moving else 0)
+        elif op == 0x21:
+            self.replies += bytes(2)  # no errors
+        elif op == 0x27:
+            self.pc = self.subroutines[cmd[3]]
+            self.stack = []
+            self.wake = self.updated
+            self.update()
+        elif op == 0x24:
+            self.pc = None
+        elif op == 0x2e:
+            self.replies.append(0 if self.pc is not None else 1)
+
+    def read(self, size=1):
+        data = bytes(self.replies[:size])
+        del self.replies[:size]
+        return data
+
+#
+# Clock for simulations that should not wait on real time. Pass it as the
+# SimulatedSerial clock and use its sleep() in place of time.sleep(). At
+# speed 0 sleeping takes no real time; otherwise it takes 1/speed as long.
+#
+class SimulatedClock:
+    def __init__(self, speed=0):
+        self.now = 0.0
+        self.speed = speed
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        self.now += seconds
+        if self.speed:
+            time.sleep(seconds/self.speed)
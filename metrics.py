@@ -0,0 +1,191 @@
+"""Low-overhead latency histograms, counters and command tracing.
+
+Hot-path instrumentation (timed, instrument, count, gauge) only records
+when the EPOCHE_METRICS environment variable is set. Otherwise timed() and
+instrument() leave the original function in place and count()/gauge()
+return after one test, so they can stay in the code permanently. serve()
+exposes everything as JSON over a ZMQ REP socket next to the command port.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+import zmq
+
+enabled = bool(os.environ.get('EPOCHE_METRICS'))
+histograms = {}
+counters = {}
+gauges = {}
+
+def tag(command, trace_id):
+    """Append a trace ID to a command string."""
+    return '{} #{}'.format(command, trace_id)
+
+def untag(command):
+    """Split 'verb args #id' into ('verb args', id); id is None if untagged."""
+    head, sep, trace_id = command.rpartition(' #')
+    if sep and trace_id.isdigit():
+        return head, int(trace_id)
+    return command, None
+
+class Histogram:
+    """Durations in power-of-two microsecond buckets.
+
+    record() is a couple of integer operations, so it is cheap enough to
+    leave on in the control loop. Percentiles are reported as the upper
+    edge of the bucket they fall in.
+    """
+
+    BUCKETS = 32  # bucket n holds durations below 2**n us; the last is open ended
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = int(seconds*1000000).bit_length()
+        self.counts[min(bucket, self.BUCKETS-1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound in seconds of the given fraction (0-1) of samples."""
+        target = fraction*self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(2**bucket/1000000, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return 'n=0'
+        return 'n={} mean={:.2f}ms p50<{:.2f}ms p90<{:.2f}ms p99<{:.2f}ms max={:.2f}ms'.format(
+            self.count, 1000*self.total/self.count, 1000*self.percentile(.5),
+            1000*self.percentile(.9), 1000*self.percentile(.99), 1000*self.max)
+
+def histogram(name):
+    """The registered histogram called `name`, created on first use."""
+    if name not in histograms:
+        histograms[name] = Histogram()
+    return histograms[name]
+
+def count(name, amount=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+def gauge(name, value):
+    if enabled:
+        gauges[name] = value
+
+def timed(name):
+    """Decorator recording each call's duration in histogram `name`."""
+    def decorate(function):
+        if not enabled:
+            return function
+        samples = histogram(name)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                samples.record(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def instrument(obj, method, name):
+    """Time obj.method(data) in place, counting calls and bytes written under `name`."""
+    if not enabled:
+        return
+    function = getattr(obj, method)
+    samples = histogram(name)
+    def wrapper(data, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(data, *args, **kwargs)
+        finally:
+            samples.record(time.perf_counter() - start)
+            counters[name + '.calls'] = counters.get(name + '.calls', 0) + 1
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                counters[name + '.bytes'] = counters.get(name + '.bytes', 0) + len(data)
+    setattr(obj, method, wrapper)
+
+def snapshot():
+    """All counters, gauges and histogram summaries as a JSON-ready dict."""
+    return {
+        'time': time.time(),
+        'counters': dict(counters),
+        'gauges': dict(gauges),
+        'histograms': {name: {
+            'count': samples.count,
+            'mean': samples.total/samples.count if samples.count else 0,
+            'p50': samples.percentile(.5),
+            'p90': samples.percentile(.9),
+            'p99': samples.percentile(.99),
+            'max': samples.max,
+        } for name, samples in list(histograms.items())},
+    }
+
+def serve(port=15789):
+    """Answer every request on `port` with snapshot() as JSON, from a daemon thread."""
+    def loop():
+        context = zmq.Context.instance()
+        stats = context.socket(zmq.REP)
+        stats.bind('tcp://*:{}'.format(port))
+        while True:
+            stats.recv()
+            stats.send_string(json.dumps(snapshot()))
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+class Tracer:
+    """Follow tagged commands through a fixed sequence of stages.
+
+    begin() starts a trace at the first stage; each later stage is stamped
+    the first time stamp() is called for it, in order, and the time since
+    the previous stage goes into that stage's histogram. Only one command is
+    followed at a time: a new begin() abandons an unfinished trace. The
+    histograms are registered as 'trace.<before>-><after>' and 'trace.total'
+    and are recorded whether or not metrics are enabled.
+    """
+
+    def __init__(self, *stages):
+        self.stages = stages
+        self.histograms = {}
+        for before, after in zip(stages, stages[1:]):
+            name = '{}->{}'.format(before, after)
+            self.histograms[name] = histogram('trace.' + name)
+        self.histograms['total'] = histogram('trace.total')
+        self.trace_id = None
+        self.next = len(stages)
+        self.started = 0
+        self.last = 0
+
+    def begin(self, trace_id):
+        self.trace_id = trace_id
+        self.next = 1
+        self.started = self.last = time.monotonic()
+
+    def stamp(self, stage):
+        if self.next >= len(self.stages) or self.stages[self.next] != stage:
+            return
+        now = time.monotonic()
+        self.histograms['{}->{}'.format(self.stages[self.next-1], stage)].record(now - self.last)
+        self.last = now
+        self.next += 1
+        if self.next == len(self.stages):
+            self.histograms['total'].record(now - self.started)
+            self.trace_id = None
+
+    def dump(self):
+        return '\n'.join('{:>16}: {}'.format(name, histogram.summary())
+                         for name, histogram in self.histograms.items())
@@ -0,0 +1,105 @@
+"""Robot-centred obstacle occupancy grid fed by Kinect depth columns."""
+
+import math
+import multiprocessing
+import time
+import numpy as np
+
+# Kinect video/depth geometry
+FOV = math.radians(57)  # horizontal field of view
+WIDTH = 640
+FOCAL = WIDTH/2/math.tan(FOV/2)  # in pixels
+MAX_RANGE = 4000  # mm; beyond this raw depth is too noisy to trust
+INVALID = 2047  # raw value for "no reading"
+
+def raw_to_mm(raw):
+    """Convert raw 11-bit Kinect depth to millimetres (0 where there is no reading)."""
+    raw = np.asarray(raw, dtype=np.float32)
+    with np.errstate(divide='ignore'):
+        mm = 1000/(raw*-0.0030711016 + 3.3309495161)
+    return np.where((raw < INVALID) & (mm > 0), mm, 0)
+
+class OccupancyGrid:
+    """Square grid of obstacle confidence around the robot.
+
+    The robot sits at the centre facing +x (rows), with +y (columns) to its
+    left. Each cell holds a confidence 0-255 and the time it was last touched;
+    confidence decays with `half_life` seconds, applied lazily when a cell is
+    read or updated, so a frame only costs the cells its rays cross. Pass
+    shared=True to back the arrays with shared memory, so a grid built before
+    forking is seen by every process.
+    """
+
+    HIT = 96  # confidence added where a ray ends on an obstacle
+    MISS = 32  # confidence removed where a ray passes through free space
+    THRESHOLD = 128  # confidence at which a cell counts as blocked
+
+    def __init__(self, size=80, resolution=50, half_life=3.0, shared=False):
+        self.size = size
+        self.resolution = resolution  # mm per cell
+        self.half_life = half_life
+        if shared:
+            self.value = np.frombuffer(multiprocessing.RawArray('B', size*size), dtype=np.uint8)
+            self.stamp = np.frombuffer(multiprocessing.RawArray('f', size*size), dtype=np.float32)
+        else:
+            self.value = np.zeros(size*size, dtype=np.uint8)
+            self.stamp = np.zeros(size*size, dtype=np.float32)
+        self.value = self.value.reshape(size, size)
+        self.stamp = self.stamp.reshape(size, size)
+        self.epoch = time.monotonic()  # stamps are float32 seconds since this
+
+    def now(self):
+        return time.monotonic() - self.epoch
+
+    def cell(self, x, y):
+        """Row, column of the cell holding robot-frame point (x, y) in mm, or None if off the grid."""
+        row = int(x//self.resolution) + self.size//2
+        col = int(y//self.resolution) + self.size//2
+        if 0 <= row < self.size and 0 <= col < self.size:
+            return row, col
+        return None
+
+    def occupancy(self, x, y):
+        """Decayed confidence (0-255) that point (x, y) in mm is blocked."""
+        cell = self.cell(x, y)
+        if cell is None:
+            return 0
+        age = self.now() - self.stamp[cell]
+        return self.value[cell] * 0.5**(age/self.half_life)
+
+    def blocked(self, x, y):
+        return self.occupancy(x, y) >= self.THRESHOLD
+
+    def update(self, depth, step=8):
+        """Fold in one raw depth frame, using every `step`-th column."""
+        columns = np.arange(0, depth.shape[1], step)
+        # nearest reading per column, as the old obstacle scan did
+        raw = depth[:, columns]
+        raw = np.where(raw > 0, raw, INVALID).min(axis=0)
+        dist = raw_to_mm(raw)
+        hit = (dist > 0) & (dist < MAX_RANGE)
+        dist = np.where(hit, dist, MAX_RANGE)
+        bearing = np.arctan((WIDTH/2 - columns)/FOCAL)
+        cos, sin = np.cos(bearing), np.sin(bearing)
+
+        # free space: sample each ray once per cell up to (not including) its end
+        r = np.arange(0, MAX_RANGE, self.resolution, dtype=np.float32)[:, None]
+        free = r < dist - self.resolution
+        free = self.flat_cells((r*cos)[free], (r*sin)[free])
+        hits = self.flat_cells((dist*cos)[hit], (dist*sin)[hit])
+        free = np.setdiff1d(free, hits)
+
+        now = self.now()
+        value = self.value.reshape(-1)
+        stamp = self.stamp.reshape(-1)
+        for cells, change in ((free, -self.MISS), (hits, self.HIT)):
+            decayed = value[cells] * 0.5**((now - stamp[cells])/self.half_life)
+            value[cells] = np.clip(decayed + change, 0, 255)
+            stamp[cells] = now
+
+    def flat_cells(self, x, y):
+        """Unique flat indices of the on-grid cells holding points x, y (mm arrays)."""
+        row = (x//self.resolution).astype(np.int64) + self.size//2
+        col = (y//self.resolution).astype(np.int64) + self.size//2
+        inside = (row >= 0) & (row < self.size) & (col >= 0) & (col < self.size)
+        return np.unique(row[inside]*self.size + col[inside])
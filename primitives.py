@@ -0,0 +1,208 @@
+"""Motion primitives precompiled into ready-to-send serial frames.
+
+A primitive is a motion function (dowalk, turn, stand, ...) run once against
+a simulated Maestro. Every pause() in it, or control.sleep() as in the
+oscillator motions, ends a frame, so the result is a list of (serial bytes,
+seconds to wait afterwards, servos to wait for, servo targets once it is
+sent). Frames are written to a cache file named by a hash of everything that
+shapes them: the motion and its arguments, the gait parameters, the servo
+calibration and limits, and the source of the motion module. Cache files are
+memory-mapped, so playing a primitive is a byte copy to the port per frame
+with no angle math.
+
+Motions are captured on their second run from a fresh controller, so a
+repeating gait is recorded in its steady state whatever runs before it, and
+every servo speed the run uses is sent explicitly rather than assumed from
+earlier commands.
+
+File layout (little-endian): magic, frame count (uint32), the 24 servo
+targets and then the 24 speeds left behind (uint16 each; target 0 and speed
+0xffff for channels the motion does not touch), then per frame its data
+offset and length (uint32), pause (float64), a bit mask of the servos it
+waits for (uint32) and the 24 targets after it, then the frame data.
+
+VERSION is part of the magic and of the cache key, so files in an older
+layout, or captured the old way, are never read; they are deleted whenever
+a new file is saved, along with all but the MAX_FILES most recently used. At most
+MAX_LOADED primitives stay mapped in a process.
+"""
+
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import maestro
+
+# bump when the file layout, or what capture() records, changes
+VERSION = 3
+MAGIC = b'EPOCHPR' + bytes([VERSION])
+COUNT = struct.Struct('<I')
+TARGETS = struct.Struct('<24H')
+FRAME = struct.Struct('<IIdI')
+UNSET = 0xffff
+
+# gait parameters that change what a motion sends
+PARAMETERS = ('forward', 'height', 'delay', 'TRAJECTORY_SHAPE')
+
+# least recently used primitives are unmapped, and cache files deleted, past these
+MAX_LOADED = 32
+MAX_FILES = 256
+
+directory = os.environ.get('EPOCHE_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+loaded = collections.OrderedDict()  # cache file -> Primitive, least recently used first
+sources = {}  # module file -> digest
+
+class Primitive:
+    """Precompiled frames of one motion, read from a mapped cache file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.data)
+        if view[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a motion primitive'.format(path))
+        offset = len(MAGIC)
+        count, = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        self.targets = TARGETS.unpack_from(view, offset)
+        offset += TARGETS.size
+        self.speeds = TARGETS.unpack_from(view, offset)
+        offset += TARGETS.size
+        self.frames = []
+        for i in range(count):
+            start, length, seconds, mask = FRAME.unpack_from(view, offset)
+            offset += FRAME.size
+            targets = TARGETS.unpack_from(view, offset)
+            offset += TARGETS.size
+            servos = [servo for servo in range(32) if mask >> servo & 1]
+            self.frames.append((view[start:start+length], seconds, servos, targets))
+
+    def play(self, control, pause):
+        """Send each frame through control.write, calling pause() after it."""
+        for data, seconds, servos, targets in self.frames:
+            self.send(control, data, targets)
+            pause(seconds, servos)
+        self.finish(control)
+
+    async def play_async(self, control, pause):
+        """play() for an event loop: pause is a coroutine function."""
+        for data, seconds, servos, targets in self.frames:
+            self.send(control, data, targets)
+            await pause(seconds, servos)
+        self.finish(control)
+
+    def send(self, control, data, targets):
+        if data:
+            control.write(data)
+            # keep the controller's targets current for wait_until_settled
+            for chan, target in enumerate(targets):
+                if target:
+                    control.Targets[chan] = target
+
+    def finish(self, control):
+        for chan, target in enumerate(self.targets):
+            if target:
+                control.Targets[chan] = target
+        for chan, speed in enumerate(self.speeds):
+            if speed != UNSET:
+                control.Speeds[chan] = speed
+
+def capture(module, name, args):
+    """Run module.name(*args) against a simulated Maestro; return its frames, final targets and speeds."""
+    clock = maestro.SimulatedClock()
+    usb = maestro.SimulatedSerial(clock=clock)
+    control = maestro.Controller(usb=usb)
+    control.clock, control.sleep = clock, clock.sleep
+    control.Mins = module.control.Mins
+    control.Maxs = module.control.Maxs
+    control.PololuCmd = module.control.PololuCmd
+    frames = []
+    sent = [0]
+    def pause(seconds, servos=None):
+        frames.append((bytes(usb.written[sent[0]:]), seconds, list(servos or []), list(control.Targets)))
+        sent[0] = len(usb.written)
+        clock.sleep(seconds)
+
+    saved = module.control, module.pause
+    module.control, module.pause = control, lambda seconds, servos=None: clock.sleep(seconds)
+    try:
+        # warm up, then record from the state the first run left
+        getattr(module, name)(*args)
+        control.Speeds = [-1] * len(control.Speeds)
+        sent[0] = len(usb.written)
+        module.pause = control.sleep = pause
+        getattr(module, name)(*args)
+    finally:
+        module.control, module.pause = saved
+    if len(usb.written) > sent[0]:
+        frames.append((bytes(usb.written[sent[0]:]), 0, [], list(control.Targets)))
+    return frames, control.Targets, control.Speeds
+
+def save(path, frames, targets, speeds):
+    header = MAGIC + COUNT.pack(len(frames)) + TARGETS.pack(*targets[:24]) + TARGETS.pack(*[UNSET if s < 0 else s for s in speeds[:24]])
+    offset = len(header) + (FRAME.size + TARGETS.size)*len(frames)
+    table = bytearray()
+    for data, seconds, servos, after in frames:
+        table += FRAME.pack(offset, len(data), seconds, sum(1 << servo for servo in servos))
+        table += TARGETS.pack(*after[:24])
+        offset += len(data)
+    # write then rename, so a reader never maps a half-written file and
+    # processes compiling the same motion at once don't write over each other
+    partial = '{}.{}.partial'.format(path, os.getpid())
+    with open(partial, 'wb') as f:
+        f.write(header)
+        f.write(table)
+        for data, seconds, servos, after in frames:
+            f.write(data)
+    os.replace(partial, path)
+
+def key(module, name, args):
+    """Hash naming the cache file for module.name(*args) under the current parameters."""
+    source = module.__file__
+    if source not in sources:
+        with open(source, 'rb') as f:
+            sources[source] = hashlib.sha1(f.read()).hexdigest()
+    control = module.control
+    parts = (VERSION, name, args, [getattr(module, p) for p in PARAMETERS], module.servo_info,
+             control.PololuCmd, control.Mins, control.Maxs, sources[source])
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+def prune(keep=MAX_FILES):
+    """Delete cache files in an older layout, and all but the `keep` most recently used."""
+    files = []
+    stale = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.bin'):
+            try:
+                with open(entry.path, 'rb') as f:
+                    current = f.read(len(MAGIC)) == MAGIC
+                (files if current else stale).append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+    files.sort(reverse=True)
+    for mtime, path in stale + files[keep:]:
+        # another process may be pruning too; a mapped file stays readable
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def load(module, name, *args):
+    """Primitive for module.name(*args), compiling and caching it if needed."""
+    path = os.path.join(directory, '{}-{}.bin'.format(name, key(module, name, args)))
+    if path in loaded:
+        loaded.move_to_end(path)
+        return loaded[path]
+    try:
+        # the modification time marks when a file was last used, for prune()
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(directory, exist_ok=True)
+        save(path, *capture(module, name, args))
+        prune()
+    loaded[path] = Primitive(path)
+    if len(loaded) > MAX_LOADED:
+        # unmapped once frames still being played let go of it
+        loaded.popitem(last=False)
+    return loaded[path]
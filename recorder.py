@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+"""Record and replay host commands and servo serial traffic.
+
+A log is an append-only binary file: an 8-byte magic string followed by
+records of (seconds since session start: float64, kind: uint8, length:
+uint16, little-endian) plus `length` payload bytes. Every Recorder opened
+on the file starts a new session with a SESSION record holding the wall
+clock time. Logs are read through mmap, so replaying a long session does
+not load it into memory.
+
+Usage:
+    recorder.py dump LOG
+    recorder.py play LOG [SPEED] [TTY]   serial traffic to TTY (default: simulated Maestro)
+    recorder.py rerun LOG OUT [SPEED]    commands through the current gait code, output to OUT
+    recorder.py diff LOG LOG             compare serial output byte for byte
+"""
+
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import maestro
+
+MAGIC = b'EPOCHLOG'
+RECORD = struct.Struct('<dBH')
+WALL = struct.Struct('<d')
+
+SESSION = 0
+COMMAND = 1
+SERIAL = 2
+KINDS = {SESSION: 'session', COMMAND: 'command', SERIAL: 'serial'}
+
+class Recorder:
+    """Append commands and serial writes to a log file."""
+
+    def __init__(self, path, clock=time.monotonic):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(MAGIC)
+        self.clock = clock
+        self.start = clock()
+        # serial writes may come from another thread (see maestro.FramePipeline)
+        self.lock = threading.Lock()
+        self.record(SESSION, WALL.pack(time.time()))
+
+    def record(self, kind, data):
+        with self.lock:
+            self.file.write(RECORD.pack(self.clock() - self.start, kind, len(data)))
+            self.file.write(data)
+
+    def command(self, command):
+        # commands are rare, so flush them; a crash loses at most some serial bytes
+        self.record(COMMAND, command.encode())
+        self.file.flush()
+
+    def serial(self, data):
+        """Log bytes written to a servo or motor port (usable as a write hook)."""
+        self.record(SERIAL, data)
+
+    def close(self):
+        self.file.close()
+
+def read(path):
+    """Yield (session, seconds, kind, payload) for each record; payloads are views into the mapped file."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(MAGIC):
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+    if view[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is not a command log'.format(path))
+    offset = len(MAGIC)
+    session = -1
+    while offset + RECORD.size <= len(view):
+        seconds, kind, length = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        if offset + length > len(view):
+            break # cut short by a crash
+        payload = view[offset:offset+length]
+        offset += length
+        if kind == SESSION:
+            session += 1
+        yield session, seconds, kind, payload
+
+def play(path, usb, speed=1.0):
+    """Write a log's serial traffic to usb at `speed` times real time (0: as fast as possible)."""
+    start = time.monotonic()
+    for session, seconds, kind, payload in read(path):
+        if kind == SESSION:
+            start = time.monotonic()
+        if kind != SERIAL:
+            continue
+        if speed:
+            wait = start + seconds/speed - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        usb.write(bytes(payload))
+
+def rerun(path, out, speed=0):
+    """Feed a log's commands through the gait code on a simulated Maestro, logging to `out`.
+
+    Gait pauses advance a simulated clock (taking 1/speed as long in real
+    time, or none at speed 0), and walking and macros continue between
+    commands as they do in epoche.run (a macro still running when the log
+    ends is played out), so the output is deterministic for a given log.
+    """
+    os.environ['EPOCHE_TTY'] = 'sim'
+    import epoche
+    clock = maestro.SimulatedClock(speed)
+    epoche.control.usb = maestro.SimulatedSerial(clock=clock)
+    epoche.control.clock = clock
+    epoche.control.sleep = clock.sleep
+    log = Recorder(out, clock=clock)
+    epoche.control.writeHooks.append(log.serial)
+
+    mode = 'paused'
+    macro = None
+    macros = 0
+    heard = 0
+    offset = 0
+    for session, seconds, kind, payload in read(path):
+        if kind == SESSION:
+            offset = clock()
+        if kind != COMMAND:
+            continue
+        due = offset + seconds
+        while clock() < due:
+            if mode in epoche.GAITS:
+                if clock() - heard > epoche.LINK_TIMEOUT:
+                    mode = 'paused'
+                    break
+                gait, d = epoche.GAITS[mode]
+                epoche.play(gait, d)
+            elif mode == 'macro':
+                if not play_macro(epoche, macro):
+                    macro = None
+                    mode = 'paused'
+            else:
+                break
+        clock.sleep(due - clock())
+        command = bytes(payload).decode()
+        log.command(command)
+        heard = clock()
+        mode = epoche.handle(command, mode)
+        if macro is not None and (mode != 'macro' or epoche.is_macro(command)):
+            macro.abort()
+            macro = None
+        if epoche.is_macro(command):
+            try:
+                steps = epoche.parse_macro(command)
+            except ValueError:
+                mode = 'paused'
+            else:
+                macros += 1
+                macro = epoche.Macro(macros, steps, None)
+    while mode == 'macro' and play_macro(epoche, macro):
+        pass
+    log.close()
+
+def play_macro(epoche, macro):
+    """Play a macro's next gait cycle, pose or pause as epoche.run does; False once it is done."""
+    unit = macro.next()
+    if unit is None:
+        return False
+    if unit[0] == 'play':
+        epoche.play(unit[1], *unit[2])
+    else:
+        epoche.pause(unit[1])
+    return True
+
+def serial_bytes(path):
+    return b''.join(bytes(payload) for _, _, kind, payload in read(path) if kind == SERIAL)
+
+def diff(a, b):
+    """Offset of the first byte where two logs' serial output differs, or None if identical."""
+    a = serial_bytes(a)
+    b = serial_bytes(b)
+    for offset, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return offset
+    if len(a) != len(b):
+        return min(len(a), len(b))
+    return None
+
+if __name__ == '__main__':
+    action = sys.argv[1]
+    if action == 'dump':
+        for session, seconds, kind, payload in read(sys.argv[2]):
+            if kind == COMMAND:
+                payload = bytes(payload).decode()
+            elif kind == SESSION:
+                payload = time.ctime(WALL.unpack(payload)[0])
+            else:
+                payload = bytes(payload).hex()
+            print('{} {:10.4f} {:7} {}'.format(session, seconds, KINDS[kind], payload))
+    elif action == 'play':
+        speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+        usb = maestro.SimulatedSerial() if len(sys.argv) < 5 else maestro.serial.Serial(sys.argv[4])
+        play(sys.argv[2], usb, speed)
+        usb.close()
+    elif action == 'rerun':
+        rerun(sys.argv[2], sys.argv[3], float(sys.argv[4]) if len(sys.argv) > 4 else 0)
+    elif action == 'diff':
+        offset = diff(sys.argv[2], sys.argv[3])
+        if offset is None:
+            print('Serial output identical.')
+        else:
+            print('Serial output differs from byte {}.'.format(offset))
+            sys.exit(1)
@@ -1,31 +1,64 @@
 #!/usr/bin/python3
 """Controls Pi on hexapod."""
 
-#import freenect
-#import numpy as np
+import collections
+import concurrent.futures
+import latest
+import metrics
 import multiprocessing
+import os
+import recorder
 import serial
+import struct
+import zlib
 import zmq
 import queue
 import time
 import sys
 
+# stop driving forward when any of these points (mm, robot frame) is
+# occupied: dead ahead, from the Kinect's minimum range of about 500 mm (it
+# reads nothing nearer) out to 600 mm. The grid is not shifted as the robot
+# drives, so an obstacle only comes closer as new frames see it, and old
+# readings stay put until they fade.
+STOP_POINTS = [(x, 0) for x in range(500, 650, 50)]
+# motor control loop period in seconds
+TICK = 0.01
+# motor board serial line; with 8N1 framing each byte takes 10 bits, so
+# one 2-byte packet per TICK uses about a tenth of it
+BAUD = 19200
+# how often link utilization is reported, in seconds
+LINK_WINDOW = 1.0
+
 class MotorControlProcess(multiprocessing.Process):
     """Send commands to motor control board."""
 
-    def __init__(self, command_queue):
+    def __init__(self, command_queue, grid=None, record=None):
         super().__init__(daemon=True)
         self.done = False
         self.queue = command_queue
+        self.grid = grid
+        self.record = record # log file for commands and motor bytes (see recorder.py)
+        self.log = None
         self.left = 0
         self.right = 0
         self.port = sys.argv[1]
-        self.ser = serial.Serial(self.port, 19200)
+        self.ser = serial.Serial(self.port, BAUD)
         print(self.ser)
+        self.window = time.monotonic()  # start of the utilization window
+        self.window_bytes = 0
 
     def run(self):
         """Continually send control signal."""
+        if metrics.enabled:
+            metrics.instrument(self.ser, 'write', 'usb.write')
+            metrics.serve()
+        if self.record:
+            self.log = recorder.Recorder(self.record)
+        tick = time.monotonic()
         while not self.done:
+            if metrics.enabled:
+                metrics.gauge('queue.depth', self.queue.qsize())
             command_flag = False
             try:
                 while True:
@@ -34,6 +67,8 @@ class MotorControlProcess(multiprocessing.Process):
             except queue.Empty:
                 pass
             if command_flag:
+                if self.log is not None:
+                    self.log.command('q' if command == 'q' else 'c {} {}'.format(*command))
                 if command == 'q':
                     self.left = 0
                     self.right = 0
@@ -42,13 +77,62 @@ class MotorControlProcess(multiprocessing.Process):
                 else:
                     self.left, self.right = command
                     print('Executing command: {} {}'.format(self.left, self.right))
+            # check every forward setpoint, new or held, before it goes out
+            if self.left + self.right > 0 and self.grid is not None and any(self.grid.blocked(*point) for point in STOP_POINTS):
+                self.left = 0
+                self.right = 0
+                print('Obstacle ahead, stopping.')
+                command_flag = True
+            if command_flag:
                 self.write()
+            self.report()
+
+            tick += TICK
+            remaining = tick - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            else:
+                metrics.count('tick.overrun')
+                tick = time.monotonic()
+        # the final stop was written above; let it reach the board
+        self.ser.flush()
         self.ser.close()
+        if self.log is not None:
+            self.log.close()
 
     def write(self):
-        """Send steer, speed to board."""
-    
-        for wheel, velocity in enumerate([self.right,self.left]):
+        """Send steer, speed to board, discarding older setpoints it hasn't taken yet.
+
+        Every byte is a complete wheel command, so bytes still waiting in the
+        OS buffer are setpoints this one makes stale: sending them late would
+        only replay old motion.
+        """
+        packet = self.encode(self.left, self.right)
+        queued = self.ser.out_waiting
+        if queued:
+            self.ser.reset_output_buffer()
+            metrics.count('link.dropped', queued)
+        if self.log is not None:
+            self.log.serial(packet)
+        self.ser.write(packet)
+        self.window_bytes += len(packet)
+
+    def report(self):
+        """Link gauges: bytes waiting in the OS buffer, and share of the line used."""
+        if not metrics.enabled:
+            return
+        now = time.monotonic()
+        metrics.gauge('link.queued', self.ser.out_waiting)
+        if now - self.window >= LINK_WINDOW:
+            metrics.gauge('link.utilization', self.window_bytes/(BAUD/10*(now - self.window)))
+            self.window = now
+            self.window_bytes = 0
+
+    @metrics.timed('encode')
+    def encode(self, left, right):
+        """Packet (one byte per wheel) setting both wheel velocities."""
+        packet = bytearray()
+        for wheel, velocity in enumerate([right,left]):
             #print('=====')
             if wheel == 0:
                 wheel = 0x00
@@ -80,99 +164,209 @@ class MotorControlProcess(multiprocessing.Process):
             result = result | checksum
             #print(result.to_bytes(1, byteorder='little', signed=False).hex())
             #print(result)
-            self.ser.write(result.to_bytes(1, byteorder='little', signed=False))
+            packet.append(result)
+        return bytes(packet)
+
+# The Kinect stack (freenect, OpenCV, NumPy) is imported where frames are
+# handled, so motor control runs on a board without it.
+
+# hsv range of the tracked target
+COLOR_MIN_HSV = (172, 128, 128)
+COLOR_MAX_HSV = (180, 255, 255)
+#COLOR_NONE_HSV = (0, 128, 128)
+#COLOR_MAX_HSV = (10, 255, 255)
+#COLOR_MIN_HSV = (170, 128, 128)
+#COLOR_ALL_HSV = (180, 255, 255)
+
+# raw depth below which a column counts as blocked
+OBSTACLE_DEPTH = 600
+
+def get_image_frame():
+    import cv2
+    import freenect
+    frame, _ = freenect.sync_get_video()
+    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+    return frame
+
+def get_depth_frame():
+    import freenect
+    frame, _ = freenect.sync_get_depth()
+    #frame = frame.astype(np.uint8)
+    return frame
+
+def find_target(image):
+    """Color stage: hsv image and bounding box of the largest target (or None)."""
+    import cv2
+    import numpy as np
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv, np.array(COLOR_MIN_HSV), np.array(COLOR_MAX_HSV))
+    #mask = cv2.inRange(hsv, COLOR_NONE_HSV, COLOR_MAX_HSV) + cv2.inRange(hsv, COLOR_MIN_HSV, COLOR_ALL_HSV)
+    res = cv2.bitwise_and(gray, gray, mask=mask)
+    res = cv2.blur(res, (40,40))
+    ret, thresh = cv2.threshold(res, 10, 255, cv2.THRESH_BINARY)
+    contours = cv2.findContours(thresh, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+    target = None
+    maxarea = 0
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if 2000 < area < 200000 and area > maxarea:
+            maxarea = area
+            target = contour
+    if target is None:
+        return hsv, None
+    return hsv, cv2.boundingRect(target)
+
+def find_obstacles(depth):
+    """Depth stage: indices of image columns with something closer than OBSTACLE_DEPTH."""
+    import numpy as np
+    mindepths = np.min(depth, axis=0)
+    return np.flatnonzero(mindepths < OBSTACLE_DEPTH)
+
+def annotate(frame_id, image, depth, target_stage, obstacle_stage):
+    """Annotation stage: merge the color and depth results of one frame."""
+    import cv2
+    hsv, target = target_stage.result()
+    obstacles = obstacle_stage.result()
+
+    # mark blocked columns along the top edge
+    image[0:31, obstacles] = (0,0,255)
+
+    # prepare info
+    y, x = image.shape[0]//2, image.shape[1]//2
+    infostring = ['Frame: {}'.format(frame_id),
+                    'Position: ({}, {})'.format(x, y),
+                    'HSV: ({:3}, {:3}, {:3})'.format(hsv[y,x,0], hsv[y,x,1], hsv[y,x,2]),
+                    'Depth: ({})'.format(depth[y,x])]
+
+    # find object
+    if target is None:
+        infostring.append('No object found!')
+    else:
+        x,y,w,h = target
+        cv2.rectangle(image, (x,y), (x+w,y+h), (0,255,0), 2)
+
+    return frame_id, image, depth, infostring
+
+# frame id, timestamp, height, width, jpeg length
+FRAME_HEADER = struct.Struct('<IdHHI')
+
+def encode_frame(frame_id, image, depth, quality=70):
+    """Pack one frame as a JPEG image followed by row-delta, deflated depth."""
+    import cv2
+    import numpy as np
+    ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    # neighbouring depth pixels are close, so row deltas are mostly tiny and deflate well
+    delta = np.diff(depth.astype(np.int16), axis=1, prepend=0)
+    packed = zlib.compress(delta.tobytes(), 1)
+    header = FRAME_HEADER.pack(frame_id, time.time(), depth.shape[0], depth.shape[1], len(jpeg))
+    return header + jpeg.tobytes() + packed
 
 class KinectControlProcess(multiprocessing.Process):
     """Get frame from Kinect."""
 
-    def __init__(self, image_queue):
+    def __init__(self, image_queue, grid=None, workers=None):
         print('Initializing Kinect thread...')
         super().__init__(daemon=True)
         self.done = False
         self.queue = image_queue
-
-    def get_image_frame():
-        frame, _ = freenect.sync_get_video()
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        return frame
-
-    def get_depth_frame():
-        frame, _ = freenect.sync_get_depth()
-        #frame = frame.astype(np.uint8)
-        return frame
+        self.grid = grid
+        # leave one core for motor control and the command loop
+        self.workers = workers or max(1, (os.cpu_count() or 1) - 1)
 
     def run(self):
-        """Continually grab Kinect frames."""
+        """Continually grab Kinect frames.
+
+        Each frame is split into color, depth and annotation stages that run
+        on a thread pool (OpenCV and NumPy release the GIL), so grabbing frame
+        N+1 overlaps processing of frame N. Up to `workers` frames are in
+        flight; results are merged by frame ID and published in order.
+        """
         print('Starting Kinect thread...')
-        #camera_port = 15788
-        #context = zmq.Context()
-        #host = context.socket(zmq.REQ)
-        #host.bind('tcp://mesa.local:{}'.format(camera_port))
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        pending = collections.deque()
+        frame_id = 0
         while not self.done:
-
-            print('Processing image frame...')
-
             image = get_image_frame()
-            # hsv mask
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-            color_min_hsv = np.array([172, 128, 128])
-            color_max_hsv = np.array([180, 255, 255])
-            #color_none_hsv = np.array([0, 128, 128])
-            #color_max_hsv = np.array([10, 255, 255])
-            #color_min_hsv = np.array([170, 128, 128])
-            #color_all_hsv = np.array([180, 255, 255])
-            mask = cv2.inRange(hsv, color_min_hsv, color_max_hsv)
-            #mask = cv2.inRange(hsv, color_none_hsv, color_max_hsv) + cv2.inRange(hsv, color_min_hsv, color_all_hsv)
-            res = cv2.bitwise_and(gray, gray, mask=mask)
-            res = cv2.blur(res, (40,40))
-            ret, thresh = cv2.threshold(res, 10, 255, cv2.THRESH_BINARY)
-            _, contours, _ = cv2.findContours(thresh, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-
-            newcontours = []
-            maxarea = 0
-            maxindex = 0
-            for contour in contours:
-                area = cv2.contourArea(contour)
-                if 2000 < cv2.contourArea(contour) < 200000:
-                    newcontours.append(contour)
-                    if area > maxarea:
-                        maxarea = area
-                        maxindex = len(newcontours)-1
-
-            # detect obstacles
             depth = get_depth_frame()
-            mindepths = np.min(depth, axis=0)
-            for i in range(len(mindepths)):
-                if mindepths[i] < 600:
-                    cv2.line(image, (i,0), (i,30), (0,0,255),1)
-
-            # prepare info
-            x = position[0]; y = position[1]
-            infostring = ['Position: ({}, {})'.format(x, y),
-                            'HSV: ({:3}, {:3}, {:3})'.format(hsv[y,x,0], hsv[y,x,1], hsv[y,x,2]),
-                            'Depth: ({})'.format(depth[y,x])]
-
-            # find object
-            if len(newcontours) == 0:
-                infostring.append('No object found!')
-            else:
-                x,y,w,h = cv2.boundingRect(newcontours[maxindex])
-                cv2.rectangle(image, (x,y), (x+w,y+h), (0,255,0), 2)
+            if self.grid is not None:
+                self.grid.update(depth)
+            # stages are queued in dependency order, so annotation never waits on unscheduled work
+            target_stage = pool.submit(find_target, image)
+            obstacle_stage = pool.submit(find_obstacles, depth)
+            pending.append(pool.submit(annotate, frame_id, image, depth, target_stage, obstacle_stage))
+            frame_id += 1
+
+            while pending and (len(pending) >= self.workers or pending[0].done()):
+                latest.put(self.queue, pending.popleft().result())
+        pool.shutdown()
 
-            print('Done processing image frame!')
+class VideoStreamProcess(multiprocessing.Process):
+    """Stream processed Kinect frames to the host.
+
+    Frames are JPEG/deflate encoded (see encode_frame) and published on their
+    own PUB socket, so video never shares a socket with commands. The image
+    queue should be bounded: the Kinect side drops the oldest frame rather
+    than block, and here a frame is skipped whenever it would exceed
+    `max_fps` or the `max_bitrate` (bits/s) budget.
+    """
+
+    def __init__(self, image_queue, port=15788, max_fps=10, max_bitrate=4000000, quality=70):
+        super().__init__(daemon=True)
+        self.done = False
+        self.queue = image_queue
+        self.port = port
+        self.max_fps = max_fps
+        self.max_bitrate = max_bitrate
+        self.quality = quality
+
+    def run(self):
+        context = zmq.Context()
+        host = context.socket(zmq.PUB)
+        host.setsockopt(zmq.SNDHWM, 2)
+        host.bind('tcp://*:{}'.format(self.port))
+
+        budget = 0 # bytes we may still send
+        last = time.monotonic()
+        while not self.done:
+            try:
+                frame_id, image, depth, info = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            now = time.monotonic()
+            if now - last < 1/self.max_fps:
+                continue
+            # token bucket holding at most one second of data
+            budget = min(budget + (now-last)*self.max_bitrate/8, self.max_bitrate/8)
+            last = now
+            frame = encode_frame(frame_id, image, depth, self.quality)
+            if len(frame) > budget:
+                continue
+            budget -= len(frame)
+            try:
+                host.send(frame, zmq.NOBLOCK)
+            except zmq.Again:
+                pass
 
 def run():
     """Main loop."""
 
+    # the depth stage fills the obstacle grid the motors check; without it
+    # there is no grid, and neither NumPy nor shared memory is needed
+    grid = None
+    #import occupancy
+    #grid = occupancy.OccupancyGrid(shared=True)
+    #image_queue = multiprocessing.Queue(maxsize=2)
+    #kinect = KinectControlProcess(image_queue, grid)
+    #kinect.start()
+    #stream = VideoStreamProcess(image_queue)
+    #stream.start()
+
     #command_queue = multiprocessing.Queue()
-    #motor = MotorControlProcess(command_queue)
+    #motor = MotorControlProcess(command_queue, grid, record=os.environ.get('EPOCHE_RECORD'))
     #motor.start()
 
-    #image_queue = multiprocessing.Queue()
-    #kinect = KinectControlProcess(image_queue)
-    #kinect.start()
-
     command_port = 15787
     context = zmq.Context()
     host = context.socket(zmq.REP)
@@ -199,6 +393,7 @@ def run():
 
     motor.done = True
     #kinect.done = True
+    #stream.done = True
     time.sleep(1) # give time for threads to finish
 
 if __name__ == '__main__':
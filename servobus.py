@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+"""Servo channels spread over several Maestros, with one writer thread per port.
+
+A ServoBus is a maestro.Controller whose channels are logical: they are
+numbered consecutively across a list of segments, each segment being
+(port, device number, channel count). Segments on the same port share the
+line and are told apart by Pololu device number; segments on different
+ports each get a thread that writes that port, so one frame goes out on
+all of them at once instead of queueing behind a single serial link.
+
+Everything above the bus still speaks the plain Pololu protocol for one
+big controller (precompiled primitives, write hooks, the recorder), and
+Router splits that stream command by command, renumbering channels and
+devices for each Maestro. Queries are sent to the Maestro that owns the
+channel; moving state, errors and script status are asked of every
+Maestro and combined.
+
+A port of 'sim' is a SimulatedSerial of its own. simulated_tty() serves
+simulated Maestros behind a pseudo-terminal, so the bus can be run over a
+real tty without hardware:
+
+    servobus.py                    send a frame over two pty stand-ins and check it
+"""
+
+import os
+import queue
+import serial
+import threading
+import tty
+import maestro
+
+DEVICE = 0x0c
+CHANNELS = 24
+
+def parse(spec):
+    """Segments from 'port[:device[:channels]],...', e.g. '/dev/ttyO1:12:9,/dev/ttyO2:12:9'."""
+    segments = []
+    for entry in spec.split(','):
+        fields = entry.split(':')
+        port = fields[0]
+        device = int(fields[1]) if len(fields) > 1 else DEVICE
+        count = int(fields[2]) if len(fields) > 2 else CHANNELS
+        segments.append((port, device, count))
+    return segments
+
+class Writer:
+    """Serial port written from its own thread, so that several ports send at once."""
+
+    def __init__(self, usb):
+        self.usb = usb
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            try:
+                self.usb.write(data)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, data):
+        self.check()
+        self.queue.put(bytes(data))
+
+    def flush(self):
+        """Wait until everything queued has been written."""
+        self.queue.join()
+        self.check()
+
+    def read(self, size=1):
+        self.flush()
+        return self.usb.read(size)
+
+    def close(self):
+        self.flush()
+        self.usb.close()
+
+class Router:
+    """Serial port stand-in that splits a Pololu stream for logical channels across Maestros."""
+
+    def __init__(self, segments, ports):
+        self.writers = {port: Writer(usb) for port, usb in ports.items()}
+        self.channels = []  # logical channel -> (writer, device, channel on that Maestro)
+        self.devices = []  # (writer, device) for each Maestro
+        for port, device, count in segments:
+            writer = self.writers[port]
+            self.devices.append((writer, device))
+            self.channels.extend((writer, device, chan) for chan in range(count))
+        self.pending = bytearray()
+        self.expected = []  # (command, [(writer, bytes)]) for each query not yet read back
+        self.replies = bytearray()
+
+    def route(self, cmd, out):
+        """Add the commands carrying out cmd to out (writer -> bytes); return the replies to expect."""
+        op = cmd[2]
+        if op in (0x04, 0x07, 0x09, 0x10):
+            writer, device, chan = self.channels[cmd[3]]
+            out.setdefault(writer, bytearray()).extend(bytes([0xaa, device, op, chan]) + cmd[4:])
+            return [(writer, 2)] if op == 0x10 else []
+        if op == 0x1f:
+            # Set Multiple Targets becomes one command per run of channels on the same Maestro
+            runs = []
+            for i in range(cmd[3]):
+                writer, device, chan = self.channels[cmd[4]+i]
+                value = cmd[5+2*i:7+2*i]
+                last = runs[-1] if runs else None
+                if last and last[0] is writer and last[1] == device and last[2] + len(last[3]) == chan:
+                    last[3].append(value)
+                else:
+                    runs.append((writer, device, chan, [value]))
+            for writer, device, chan, values in runs:
+                out.setdefault(writer, bytearray()).extend(
+                    bytes([0xaa, device, 0x1f, len(values), chan]) + b''.join(values))
+            return []
+        # everything else is for the whole controller, so every Maestro gets it
+        for writer, device in self.devices:
+            out.setdefault(writer, bytearray()).extend(bytes([0xaa, device]) + cmd[2:])
+        if op == 0x13 or op == 0x2e:
+            return [(writer, 1) for writer, device in self.devices]
+        if op == 0x21:
+            return [(writer, 2) for writer, device in self.devices]
+        return []
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = bytes(data, 'latin-1')
+        self.pending += data
+        out = {}
+        while True:
+            length = maestro.commandLength(self.pending)
+            if not length or len(self.pending) < length:
+                break
+            cmd = bytes(self.pending[:length])
+            del self.pending[:length]
+            reads = self.route(cmd, out)
+            if reads:
+                self.expected.append((cmd[2], reads))
+        for writer, commands in out.items():
+            writer.write(commands)
+        return len(data)
+
+    def read(self, size=1):
+        while len(self.replies) < size and self.expected:
+            op, reads = self.expected.pop(0)
+            answers = [bytearray(writer.read(count)) for writer, count in reads]
+            if op == 0x13:
+                # moving if any Maestro is
+                self.replies.append(max(answer[0] for answer in answers))
+            elif op == 0x2e:
+                # running (0) if any Maestro's script is
+                self.replies.append(min(answer[0] for answer in answers))
+            elif op == 0x21:
+                errors = 0
+                for answer in answers:
+                    errors |= answer[0] | answer[1] << 8
+                self.replies += bytes([errors & 0xff, errors >> 8])
+            else:
+                self.replies += answers[0]
+        data = bytes(self.replies[:size])
+        del self.replies[:size]
+        return data
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+class ServoBus(maestro.Controller):
+    """Controller for the logical channels of several Maestros; see the module docstring."""
+
+    def __init__(self, segments, ports=None):
+        ports = dict(ports or {})
+        named = {}
+        for i, (port, device, count) in enumerate(segments):
+            if port == 'sim':
+                # each simulated segment is a Maestro on a line of its own
+                port = 'sim{}'.format(i)
+                ports[port] = maestro.SimulatedSerial(channels=count)
+            elif port not in ports:
+                ports[port] = serial.Serial(port)
+            named[i] = port
+        self.segments = [(named[i], device, count) for i, (port, device, count) in enumerate(segments)]
+        maestro.Controller.__init__(self, usb=Router(self.segments, ports))
+        count = len(self.usb.channels)
+        self.Targets = [0] * count
+        self.Mins = [0] * count
+        self.Maxs = [0] * count
+        self.Speeds = [0] * count
+
+def simulated_tty(*maestros):
+    """Path of a pseudo-terminal whose far end is served by simulated Maestros.
+
+    Give each SimulatedSerial its device number to share one line. The
+    returned path opens like any serial port; the serving thread runs until
+    the process exits.
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    def serve():
+        pending = bytearray()
+        while True:
+            pending += os.read(master, 4096)
+            while True:
+                length = maestro.commandLength(pending)
+                if not length or len(pending) < length:
+                    break
+                for simulated in maestros:
+                    simulated.write(bytes(pending[:length]))
+                    reply = simulated.read(len(simulated.replies))
+                    if reply:
+                        os.write(master, reply)
+                del pending[:length]
+    # the slave end stays open here so the pty survives ports being closed
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.slave = slave
+    thread.start()
+    return path
+
+if __name__ == '__main__':
+    # two Maestros sharing the first port by device number, and a third on its own port
+    first, second, third = (maestro.SimulatedSerial(device=device) for device in (12, 13, 12))
+    one = simulated_tty(first, second)
+    two = simulated_tty(third)
+    bus = ServoBus([(one, 12, 6), (one, 13, 6), (two, 12, 6)])
+    targets = {chan: 4000 + 100*chan for chan in range(18)}
+    bus.setSpeeds({chan: 0 for chan in range(18)})
+    bus.setTargets(targets)
+    positions = bus.getPositions(list(range(18)))
+    expected = [targets[chan] for chan in range(18)]
+    print('positions', positions)
+    print('moving', bus.getMovingState())
+    for name, simulated in zip(('one:12', 'one:13', 'two:12'), (first, second, third)):
+        print(name, simulated.Targets[:6])
+    bus.close()
+    print('ok' if positions == expected else 'MISMATCH')
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+"""Search gait parameters on the kinematic simulator, using every core.
+
+Each configuration (delay, forward, height and swing profile) is walked for
+a few cycles by gaitsim.evaluate in a process pool. Configurations come from
+a grid (every combination of the listed values) or are drawn at random from
+ranges. Results stream to a column store as they finish: a directory with
+one little-endian float64 file per column in COLUMNS, appended a row at a
+time. Each sweep needs a directory of its own. A sweep can be read with
+load() while it runs or after it is stopped. The profile column holds an
+index into gaitsim.PROFILES.
+
+Configurations are ranked by speed (mm/s walking, degrees/s turning) among
+those whose stability margin never drops below MARGIN mm. The first cycle,
+which starts from the standing pose, is left out of the averages.
+
+Usage: sweep.py OUT [MODE] [--samples N] [--cycles N] [--top N] name=values ...
+    name is delay, forward, height or profile. values is a comma-separated
+    list, or lo:hi for a uniform range (which needs --samples; listed
+    values are then drawn at random too). Parameters not given keep their
+    epoche defaults; the profile defaults to every one in gaitsim.PROFILES.
+"""
+
+import itertools
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import numpy as np
+import gaitsim
+
+COLUMNS = ('delay', 'forward', 'height', 'profile', 'speed', 'drift', 'slip', 'margin')
+MARGIN = 20.0
+
+# the displacement each mode makes progress in, and its sign
+PROGRESS = {
+    'forward': ('forward', 1),
+    'back': ('forward', -1),
+    'right': ('turn', -1),
+    'left': ('turn', 1),
+}
+
+def configurations(axes, samples=None, seed=None):
+    """Parameter dicts from {name: values}; values are lists, or (lo, hi) ranges when sampling."""
+    if samples is None:
+        names = list(axes)
+        for values in itertools.product(*(axes[name] for name in names)):
+            yield dict(zip(names, values))
+        return
+    generator = random.Random(seed)
+    for _ in range(samples):
+        yield dict((name, generator.uniform(*values) if isinstance(values, tuple) else generator.choice(values))
+                   for name, values in axes.items())
+
+def use_cache(directory):
+    """Worker initializer: compile primitives into `directory` rather than the robot's cache."""
+    # every configuration is a new cache key, and would push the robot's own out
+    gaitsim.epoche.primitives.directory = directory
+
+def simulate(job):
+    """Worker: walk one configuration and return its row for COLUMNS."""
+    mode, cycles, parameters = job
+    parameters = dict(parameters)
+    profile = parameters.pop('profile')
+    try:
+        results = gaitsim.evaluate(mode, cycles, profile, **parameters)[0]
+    except Exception as e:
+        print('{} {} failed: {}'.format(profile, parameters, e))
+        results = []
+    steady = results[1:] or results
+    if steady:
+        measure, sign = PROGRESS[mode]
+        seconds = sum(r['seconds'] for r in steady)
+        speed = sign*sum(r[measure] for r in steady)/seconds
+        if measure == 'turn':
+            drift = np.mean([np.hypot(r['forward'], r['right']) for r in steady])
+        else:
+            drift = np.mean([abs(r['right']) for r in steady])
+        slip = np.mean([r['slip'] for r in steady])
+        margin = min(r['margin'] for r in steady)
+    else:
+        speed = drift = slip = margin = np.nan
+    return (parameters.get('delay', gaitsim.epoche.delay), parameters.get('forward', gaitsim.epoche.forward),
+            parameters.get('height', gaitsim.epoche.height), gaitsim.PROFILES.index(profile),
+            speed, drift, slip, margin)
+
+class ColumnWriter:
+    """Appends rows to a new directory of per-column float64 files."""
+
+    def __init__(self, path, columns=COLUMNS):
+        os.makedirs(path, exist_ok=True)
+        names = [os.path.join(path, column + '.f8') for column in columns]
+        # rows of an earlier sweep would be ranked along with this one's
+        if any(os.path.exists(name) for name in names):
+            raise FileExistsError('{} already holds a sweep'.format(path))
+        self.files = [open(name, 'xb') for name in names]
+
+    def append(self, row):
+        for f, value in zip(self.files, row):
+            f.write(np.float64(value).tobytes())
+            f.flush()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+def load(path, columns=COLUMNS):
+    """{column: array} of a sweep, trimmed to the rows every column has."""
+    data = dict((column, np.fromfile(os.path.join(path, column + '.f8'), dtype='<f8')) for column in columns)
+    rows = min(len(values) for values in data.values())
+    return dict((column, values[:rows]) for column, values in data.items())
+
+def rank(data, margin=MARGIN):
+    """Row indices of stable configurations, fastest first."""
+    stable = np.flatnonzero(data['margin'] >= margin)
+    return stable[np.argsort(-data['speed'][stable], kind='stable')]
+
+def sweep(path, mode='forward', axes=None, samples=None, cycles=4, processes=None, seed=None):
+    """Simulate every configuration across a process pool, writing rows to a new store at path."""
+    axes = dict(axes or {})
+    axes.setdefault('profile', list(gaitsim.PROFILES))
+    jobs = [(mode, cycles, parameters) for parameters in configurations(axes, samples, seed)]
+    writer = ColumnWriter(path)
+    start = time.perf_counter()
+    try:
+        with tempfile.TemporaryDirectory(prefix='sweep-') as cache, \
+                multiprocessing.Pool(processes, use_cache, (cache,)) as pool:
+            for n, row in enumerate(pool.imap_unordered(simulate, jobs), 1):
+                writer.append(row)
+                if n % 100 == 0 or n == len(jobs):
+                    print('{}/{} configurations in {:.0f}s'.format(n, len(jobs), time.perf_counter() - start))
+    finally:
+        writer.close()
+    return len(jobs)
+
+def report(data, top=10, margin=MARGIN):
+    print('  delay forward  height  profile    speed   drift    slip  margin')
+    for i in rank(data, margin)[:top]:
+        print('{:7.3f} {:7.1f} {:7.1f}  {:8} {:7.1f} {:7.1f} {:7.1f} {:7.1f}'.format(
+            data['delay'][i], data['forward'][i], data['height'][i], gaitsim.PROFILES[int(data['profile'][i])],
+            data['speed'][i], data['drift'][i], data['slip'][i], data['margin'][i]))
+
+def option(args, name, default):
+    if name in args:
+        i = args.index(name)
+        value = args[i+1]
+        del args[i:i+2]
+        return int(value)
+    return default
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    samples = option(args, '--samples', None)
+    cycles = option(args, '--cycles', 4)
+    top = option(args, '--top', 10)
+    axes = {}
+    for arg in [arg for arg in args if '=' in arg]:
+        name, values = arg.split('=')
+        if name == 'profile':
+            axes[name] = values.split(',')
+        elif ':' in values:
+            axes[name] = tuple(float(value) for value in values.split(':'))
+        else:
+            axes[name] = [float(value) for value in values.split(',')]
+    args = [arg for arg in args if '=' not in arg]
+    if samples is None and any(isinstance(values, tuple) for values in axes.values()):
+        sys.exit('ranges need --samples')
+    path = args[0]
+    mode = args[1] if len(args) > 1 else 'forward'
+    try:
+        sweep(path, mode, axes, samples, cycles)
+    except FileExistsError as e:
+        sys.exit(e)
+    report(load(path), top)
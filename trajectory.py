@@ -0,0 +1,39 @@
+"""Foot trajectories for smooth tripod gaits.
+
+plan() describes one gait cycle for all six feet, tick by tick, in units of
+the stride: `along` runs from +1/2 (front of the stride) to -1/2 (back) and
+`up` from 0 (on the ground) to 1 (full lift). Each foot spends the first
+half of its cycle in stance, sliding back at constant speed while it
+carries the body, and the second half in swing, returning to the front
+along a curve that leaves and meets the ground with zero velocity. The
+tripods (legs 0, 3, 4 and 1, 2, 5) are half a cycle apart. Scaling
+`along` to mm or degrees and `up` to mm, and solving the resulting foot
+positions, is up to the caller (see epoche.gait_table).
+"""
+
+import numpy as np
+
+# legs of the tripod that swings second
+SECOND = (1, 2, 5)
+
+def cycloid(s):
+    """Swing progress and lift at swing fraction s (0-1) along a cycloid."""
+    return s - np.sin(2*np.pi*s)/(2*np.pi), (1 - np.cos(2*np.pi*s))/2
+
+def bezier(s):
+    """Swing progress and lift at swing fraction s along cubic Bezier curves."""
+    # control points 0, 0, 1, 1 forward and 0, 4/3, 4/3, 0 up
+    return 3*s**2 - 2*s**3, 4*s*(1 - s)
+
+SHAPES = {'cycloid': cycloid, 'bezier': bezier}
+
+def plan(period, tick, shape='cycloid'):
+    """(along, up): arrays of shape (ticks, 6) for one cycle of `period` seconds."""
+    ticks = max(2, int(round(period/tick)))
+    phase = np.arange(ticks)[:, None]/ticks + np.array([0.5 if leg in SECOND else 0 for leg in range(6)])
+    phase %= 1
+    stance = phase < 0.5
+    progress, lift = SHAPES[shape](np.where(stance, 0, phase*2 - 1))
+    along = np.where(stance, 0.5 - phase*2, progress - 0.5)
+    up = np.where(stance, 0, lift)
+    return along, up